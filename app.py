@@ -4,7 +4,6 @@ import os
 import time
 import logging
 import io
-from importlib import import_module
 import threading
 from os.path import join, dirname
 from dotenv import load_dotenv
@@ -12,15 +11,17 @@ from dotenv import load_dotenv
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
-from flask import Flask, render_template, Response, jsonify, make_response, send_file, request
+from flask import Flask, render_template, Response, jsonify, make_response, send_file, request, abort
 from flask_httpauth import HTTPBasicAuth
-import cv2
 
 import utils
-Camera = import_module(
-    'camera.camera_' + os.environ.get('CAMERA', 'opencv')).Camera
-
-from camera.rtsp_server import start_rtsp, RTSP_URL
+import detection
+import reporting
+import streaming
+from camera import encoders, metrics
+from camera.frame import MJPEG_MIMETYPE
+from camera.base_camera import FULL_RATE
+from camera.registry import get_camera, camera_ids, DEFAULT_CAMERA_ID
 
 
 log_formatter = logging.Formatter(
@@ -37,12 +38,16 @@ console_handler.setFormatter(log_formatter)
 root_logger.addHandler(console_handler)
 
 root_logger.setLevel(logging.DEBUG)
-logging.getLogger('apscheduler').setLevel(logging.DEBUG)
 
 
 app = Flask(__name__)
 app.use_reloader = False
 THROTTLE_SECONDS = int(os.environ.get('THROTTLE_SECONDS', 5))
+# threaded (Flask's server, a thread per client) or asgi (uvicorn, streams
+# served as coroutines)
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded')
+if SERVER_MODE not in ('threaded', 'asgi'):
+    raise ValueError('SERVER_MODE must be threaded or asgi, got "%s"' % SERVER_MODE)
 MAX_IO_RETRIES = int(os.environ.get('MAX_IO_RETRIES', 1))
 
 # get this from https://doorman.printdebug.com and keep it safe! it's how reports are verified and sent upstream
@@ -65,81 +70,157 @@ def verify(username, password):
     return USER_DATA.get(username) == password
 
 
-@app.route('/live')
+def camera_or_404(cam_id):
+    try:
+        return get_camera(cam_id)
+    except KeyError:
+        abort(404)
+
+
+def camera_ok(camera):
+    try:
+        return camera.get_frame() is not None
+    except IOError as e:
+        root_logger.error(str(e))
+        return False
+
+
+@app.route('/live', defaults={'cam_id': None})
+@app.route('/live/<cam_id>')
 @auth.login_required
-def index():
-    return render_template('index.html')
+def index(cam_id):
+    camera_or_404(cam_id)
+    return render_template('index.html', cam_id=cam_id)
 
 
 @app.route('/')
 @auth.login_required
 def ping():
-    camera = Camera()
+    cameras = {cam_id: camera_ok(get_camera(cam_id))
+               for cam_id in camera_ids()}
     return jsonify({
-        'camera': camera.get_frame() is not None
+        'camera': cameras[DEFAULT_CAMERA_ID],
+        'cameras': cameras
     })
 
 
-def gen(camera):
-    while True:
-        _, frame = camera.get_frame()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame.tostring() + b'\r\n\r\n')
-
-
-@app.route('/video_feed')
+@app.route('/video_feed', defaults={'cam_id': None})
+@app.route('/video_feed/<cam_id>')
 @auth.login_required
-def video_feed():
-    return Response(gen(Camera()),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+def video_feed(cam_id):
+    camera = camera_or_404(cam_id)
+    try:
+        options = streaming.StreamOptions.from_args(request.args)
+    except ValueError as e:
+        return make_response(jsonify({'status': 'error', 'message': str(e)}), 400)
+    return Response(streaming.mjpeg_parts(camera, options), mimetype=MJPEG_MIMETYPE)
 
 
-@app.route('/frame')
+@app.route('/frame', defaults={'cam_id': None})
+@app.route('/frame/<cam_id>')
 @auth.login_required
-def get_frame():
-    return send_file(io.BytesIO(Camera().get_frame()[1].tostring()), mimetype='image/jpeg')
+def get_frame(cam_id):
+    camera = camera_or_404(cam_id)
+    return send_file(io.BytesIO(camera.get_frame().jpeg(settings=encoders.STREAM)),
+                     mimetype='image/jpeg')
 
 
-def read_and_process(camera):
-    image, jpg = camera.get_frame()
-    detections = utils.check_detect(jpg)
-    return detections, image, jpg
+def read_and_process(camera, after=None):
+    frame = camera.get_frame(after=after)
+    detections = utils.detect_frame(frame, detection.get_cache(camera))
+    return detections, frame
 
 
-@app.route('/process')
+@app.route('/process', defaults={'cam_id': None})
+@app.route('/process/<cam_id>')
 @auth.login_required
-def process_single_frame():
+def process_single_frame(cam_id):
+    camera = camera_or_404(cam_id)
     try:
-        camera = Camera()
-        detections, _, _ = read_and_process(camera)
+        detections, _ = read_and_process(camera)
         return jsonify(detections)
     except IOError as e:
         root_logger.error(str(e))
         return make_response(jsonify({'status': 'error', 'message': 'failed to read camera', 'error': str(e)}), 500)
 
 
-@app.route('/stream-detect')
+@app.route('/stream-detect', defaults={'cam_id': None})
+@app.route('/stream-detect/<cam_id>')
 @auth.login_required
-def detect():
+def detect(cam_id):
+    camera = camera_or_404(cam_id)
+
     # http://flask.pocoo.org/docs/0.12/patterns/streaming/
     def generate_detections():
         root_logger.info('Beginning to read and process frames')
-        while True:
-            detections, image, jpg = read_and_process(Camera())
-            if detections['results']:
-                root_logger.info('Detected objects, altering frame')
-                for boxes in detections['results']:
-                    image = utils.draw_boxes(image, boxes)
-                    _, jpg = cv2.imencode('.jpg', image)
-            else:
-                root_logger.info(
-                    'No objects recognized, passing original back frame')
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + jpg.tostring() + b'\r\n\r\n')
-            if os.environ.get('THROTTLE_SERVER', False):
-                time.sleep(THROTTLE_SECONDS)
-    return Response(generate_detections(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+        # detection runs in the background on the newest frame, the stream
+        # itself runs at the camera rate with the latest boxes drawn on it
+        worker = detection.get_worker(camera)
+        throttle = os.environ.get('THROTTLE_SERVER', False)
+        fps = 1.0 / THROTTLE_SECONDS if throttle and THROTTLE_SECONDS else FULL_RATE
+        viewers = streaming.VIEWERS.labels(camera.name, 'detect')
+        viewers.inc()
+        try:
+            seq = None
+            while True:
+                frame = camera.get_frame(after=seq, fps=fps)
+                seq = frame.seq
+                worker.submit(frame)
+                part = detection.annotated_part(frame, worker.result)
+                # a viewer slower than the camera would keep it for long
+                del frame
+                yield part
+                if throttle:
+                    time.sleep(THROTTLE_SECONDS)
+        finally:
+            viewers.dec()
+    return Response(generate_detections(), mimetype=MJPEG_MIMETYPE)
+
+
+@app.route('/detections', defaults={'cam_id': None})
+@app.route('/detections/<cam_id>')
+@auth.login_required
+def latest_detections(cam_id):
+    camera = camera_or_404(cam_id)
+    result = detection.get_worker(camera).result
+    if result is None:
+        return make_response(jsonify({'status': 'error', 'message': 'no detections yet'}), 404)
+    return jsonify(dict(result.as_dict(), cache=detection.get_cache(camera).stats()))
+
+
+@app.route('/storage')
+@auth.login_required
+def storage_stats():
+    return jsonify(utils.CAPTURE_STORAGE.stats())
+
+
+@app.route('/metrics')
+@auth.login_required
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+if SERVER_MODE == 'asgi':
+    # async generators, Python 3.6+, only the asgi mode needs them
+    import asgi
+
+    asgi_app = asgi.AsgiApp(
+        app, verify,
+        throttle_seconds=THROTTLE_SECONDS if os.environ.get('THROTTLE_SERVER', False) else None)
+
+
+def run_server():
+    if SERVER_MODE == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            raise ImportError('SERVER_MODE=asgi needs uvicorn, pip install uvicorn')
+        uvicorn.run(asgi_app, host='0.0.0.0', port=5000, log_level='warning')
+    else:
+        app.run(host='0.0.0.0',
+                debug=os.environ.get('DEBUG') == 'True',
+                threaded=True,
+                use_reloader=False)
 
 
 @app.route('/verify-key')
@@ -153,13 +234,21 @@ def verify_upstream_key():
 
 
 if __name__ == '__main__':
-    root_logger.info('Starting Flask server thread')
+    # imported here so that serving the app from elsewhere (uvicorn,
+    # benchmarks.server) doesn't need GStreamer
+    from camera.rtsp_server import start_rtsp, RTSP_URL
+
+    root_logger.info('Starting %s server thread', SERVER_MODE)
     root_logger.info('Starting RTSP thread, hosted on %s', RTSP_URL)
-    threading.Thread(target=lambda: app.run(
-        host='0.0.0.0', 
-        debug=os.environ.get('DEBUG') == 'True',
-        use_reloader=False)).start()
-    threading.Thread(target=lambda: start_rtsp(Camera),
+    threading.Thread(target=run_server).start()
+    threading.Thread(target=lambda: start_rtsp([get_camera(cam_id) for cam_id in camera_ids()],
+                                               annotate=detection.annotate),
                      daemon=True).start()
-    threading.Thread(target=utils.start_motion_tracker,
+    threading.Thread(target=reporting.start_report_worker,
+                     name='report-worker',
                      daemon=True).start()
+    for cam_id in camera_ids():
+        threading.Thread(target=utils.start_motion_tracker,
+                         args=(get_camera(cam_id),),
+                         name='tracker-%s' % cam_id,
+                         daemon=True).start()
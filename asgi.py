@@ -0,0 +1,279 @@
+"""Asyncio serving mode.
+
+With SERVER_MODE=asgi, app.py serves through an ASGI server (uvicorn)
+instead of Flask's threaded development server; `SERVER_MODE=asgi uvicorn
+app:asgi_app` works too. The streams, /video_feed and /stream-detect, are
+served natively: every viewer is a coroutine awaiting
+BaseCamera.get_frame_async() rather than a thread blocked in get_frame().
+Sending a part waits until the server has handed it to the client, so a
+slow viewer holds at most one part and then skips straight to the newest
+frame. Every other route goes to the Flask app on a worker thread, so
+routes and basic auth behave as before.
+
+The streams are async generators, which need Python 3.6. app.py only
+imports this module in asgi mode, so the threaded mode still runs on 3.5.
+"""
+import re
+import sys
+import time
+import json
+import base64
+import asyncio
+import functools
+import logging
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+
+import detection
+import streaming
+from camera import encoders
+from camera.frame import MJPEG_MIMETYPE
+from camera.base_camera import FULL_RATE
+from camera.registry import get_camera
+
+logger = logging.getLogger()
+
+STREAM_ROUTE = re.compile(r'^/(video_feed|stream-detect)(?:/([^/]+))?/?$')
+
+
+class AsgiApp(object):
+    """ASGI application serving the streams itself and the rest through
+    flask_app.
+
+    verify(username, password) checks the basic auth credentials of stream
+    requests, throttle_seconds is the pause between /stream-detect frames
+    (None for none).
+    """
+
+    def __init__(self, flask_app, verify, throttle_seconds=None):
+        self.flask_app = flask_app
+        self.verify = verify
+        self.throttle_seconds = throttle_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await _lifespan(receive, send)
+        elif scope['type'] == 'http':
+            match = STREAM_ROUTE.match(scope['path'])
+            if match and scope['method'] in ('GET', 'HEAD'):
+                await self._stream(scope, receive, send, *match.groups())
+            else:
+                await self._wsgi(scope, receive, send)
+
+    def _authorized(self, scope):
+        for name, value in scope['headers']:
+            if name == b'authorization':
+                kind, _, credentials = value.decode('latin-1').partition(' ')
+                if kind.lower() != 'basic':
+                    return False
+                try:
+                    username, _, password = base64.b64decode(
+                        credentials).decode('utf-8').partition(':')
+                except (ValueError, UnicodeDecodeError):
+                    return False
+                return bool(self.verify(username, password))
+        return False
+
+    async def _stream(self, scope, receive, send, route, cam_id):
+        if not self._authorized(scope):
+            await _respond(send, 401, b'Unauthorized Access', [
+                (b'www-authenticate', b'Basic realm="Authentication Required"')])
+            return
+        try:
+            camera = get_camera(cam_id)
+        except KeyError:
+            await _respond(send, 404, b'Not Found')
+            return
+
+        if route == 'video_feed':
+            args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1')))
+            try:
+                options = streaming.StreamOptions.from_args(args)
+            except ValueError as e:
+                await _respond(send, 400, json.dumps(
+                    {'status': 'error', 'message': str(e)}).encode(),
+                    [(b'content-type', b'application/json')])
+                return
+            parts = mjpeg_parts(camera, options)
+        else:
+            parts = self._detection_parts(camera)
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', MJPEG_MIMETYPE.encode())]})
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        # stream until the client goes away
+        pump = asyncio.ensure_future(_pump(parts, send))
+        disconnect = asyncio.ensure_future(_disconnected(receive))
+        await asyncio.wait([pump, disconnect],
+                           return_when=asyncio.FIRST_COMPLETED)
+        for task in (pump, disconnect):
+            task.cancel()
+        try:
+            await pump
+        except asyncio.CancelledError:
+            pass
+        except IOError as e:
+            logger.error(str(e))
+        finally:
+            await parts.aclose()
+
+    async def _detection_parts(self, camera):
+        worker = detection.get_worker(camera)
+        throttle = self.throttle_seconds
+        fps = 1.0 / throttle if throttle else FULL_RATE
+        loop = asyncio.get_event_loop()
+        viewers = streaming.VIEWERS.labels(camera.name, 'detect')
+        viewers.inc()
+        try:
+            seq = None
+            while True:
+                frame = await camera.get_frame_async(after=seq, fps=fps)
+                seq = frame.seq
+                worker.submit(frame)
+                part = await loop.run_in_executor(
+                    None, detection.annotated_part, frame, worker.result)
+                del frame
+                yield part
+                if throttle:
+                    await asyncio.sleep(throttle)
+        finally:
+            viewers.dec()
+
+    async def _wsgi(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        environ = _environ(scope, b''.join(body))
+        status, headers, content = await asyncio.get_event_loop().run_in_executor(
+            None, _call_wsgi, self.flask_app.wsgi_app, environ)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+
+async def mjpeg_parts(camera, options=None):
+    """streaming.mjpeg_parts() for coroutines.
+
+    Encoding is left to a worker thread so the event loop keeps serving
+    other viewers, only the first viewer of a variant pays for it, the
+    others find the part already cached on the frame.
+    """
+    options = options or streaming.StreamOptions()
+    variants = streaming.get_variants(camera)
+    width, quality = variants.select(options.variant)
+    settings = encoders.STREAM.with_quality(quality)
+    interval = 1.0 / options.fps if options.fps else 0
+    fps = options.fps or FULL_RATE
+    loop = asyncio.get_event_loop()
+    viewers = streaming.VIEWERS.labels(camera.name, 'mjpeg')
+    viewers.inc()
+    try:
+        seq = None
+        while True:
+            started = time.time()
+            frame = await camera.get_frame_async(after=seq, fps=fps)
+            seq = frame.seq
+            variants.touch((width, quality))
+            part = frame.cached(('mjpeg_part', settings, width))
+            if part is None:
+                part = await loop.run_in_executor(
+                    None, functools.partial(frame.mjpeg_part, width=width,
+                                            settings=settings))
+            # only the part is held while the viewer takes it, see
+            # streaming.mjpeg_parts()
+            del frame
+            yield part
+            if interval:
+                await asyncio.sleep(max(0, interval - (time.time() - started)))
+    finally:
+        viewers.dec()
+
+
+async def _pump(parts, send):
+    async for part in parts:
+        await send({'type': 'http.response.body', 'body': part,
+                    'more_body': True})
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _respond(send, status, body, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-length', str(len(body)).encode())] +
+                list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def _environ(scope, body):
+    """The WSGI environ (PEP 3333) of an ASGI http scope."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = \
+            scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def _call_wsgi(wsgi_app, environ):
+    """Run a WSGI app to completion, returns (status, headers, body)."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'),
+                                value.encode('latin-1'))
+                               for name, value in headers]
+
+    result = wsgi_app(environ, start_response)
+    try:
+        content = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], content
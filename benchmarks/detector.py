@@ -0,0 +1,61 @@
+"""Stand-in for the remote YOLO detector.
+
+Answers every POST with one canned detection after rtt seconds, so the
+detection paths can be measured against a known round trip time without
+a GPU box on the network.
+"""
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DETECTIONS = {
+    'results': [{
+        'label': 'person',
+        'confidence': 0.9,
+        'topleft': {'x': 40, 'y': 60},
+        'bottomright': {'x': 200, 'y': 400}
+    }]
+}
+
+
+class DetectorStub(object):
+    def __init__(self, rtt=0.0, host='127.0.0.1', port=0):
+        self.rtt = rtt
+        self.requests = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                time.sleep(stub.rtt)
+                with stub.lock:
+                    stub.requests += 1
+                body = json.dumps(DETECTIONS).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%i/detect' % (host, port)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='detector-stub')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,397 @@
+"""End to end benchmarks.
+
+    python -m benchmarks.run --output results.json
+
+Starts a stand-in detector (benchmarks.detector) and the app's HTTP server
+(benchmarks.server) in a subprocess driven by a stamped replay camera, then
+measures:
+
+    latency       capture to client latency percentiles of one viewer
+    fanout        sustained fps per viewer as /video_feed viewers scale up
+    stream_detect /stream-detect and detector throughput against detector RTT
+    motion        CPU seconds per frame of motion detection (in process)
+    memory        server memory growth under a steady load
+
+Latency and dropped frames are read from the index and capture time the
+replay camera stamps into every frame. Results are written as JSON, run
+with --scenarios to pick a subset. Linux only, server CPU and memory are
+read from /proc.
+
+The server runs with the detection cache off (--detect-cache-size 0) so
+stream_detect measures detector round trips rather than cache hits. The
+RTSP streams are not measured: benchmarks.server doesn't start the RTSP
+server, which needs GStreamer and an RTSP client to read it back.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+
+import cv2
+import numpy as np
+import requests
+
+from benchmarks.detector import DetectorStub
+from camera.camera_replay import Camera as ReplayCamera, read_stamp, stamp_age
+from motion import MotionDetector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SCENARIOS = ('latency', 'fanout', 'stream_detect', 'motion', 'memory')
+CAMERA_ID = 'bench'
+USERNAME, PASSWORD = 'bench', 'bench'
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _percentiles(values, scale=1.0):
+    if not len(values):
+        return None
+    values = np.asarray(values) * scale
+    return {
+        'p50': round(float(np.percentile(values, 50)), 3),
+        'p90': round(float(np.percentile(values, 90)), 3),
+        'p99': round(float(np.percentile(values, 99)), 3),
+        'max': round(float(np.max(values)), 3)
+    }
+
+
+class Server(object):
+    """The app in a subprocess, with its /proc accounting."""
+
+    def __init__(self, detector_url, fps, size, detect_cache_size=0):
+        self.port = _free_port()
+        env = dict(os.environ)
+        env.update({
+            'CAMERAS': '%s=replay' % CAMERA_ID,
+            'REPLAY_FPS': str(fps),
+            'REPLAY_SIZE': size,
+            'REPLAY_STAMP': 'True',
+            'REMOTE_DETECT_SERVER': detector_url,
+            'DETECT_CACHE_SIZE': str(detect_cache_size),
+            'REPORT_UP': 'False',
+            'STREAM_ROOT_USERNAME': USERNAME,
+            'STREAM_ROOT_PASSWORD': PASSWORD,
+            'STREAM_API_USERNAME': USERNAME,
+            'STREAM_API_PASSWORD': PASSWORD
+        })
+        env.pop('THROTTLE_SERVER', None)
+        for name in ('DETECT_API_USERNAME', 'DETECT_API_PASSWORD',
+                     'UPSTREAM_SECRET_KEY'):
+            env.setdefault(name, 'bench')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.server', str(self.port)],
+            cwd=ROOT, env=env)
+        self.url = 'http://127.0.0.1:%i' % self.port
+
+    def wait_ready(self, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('Benchmark server exited with %i'
+                                   % self.process.returncode)
+            try:
+                if requests.get(self.url + '/', auth=(USERNAME, PASSWORD),
+                                timeout=5).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError('Benchmark server did not come up')
+
+    def cpu_seconds(self):
+        try:
+            with open('/proc/%i/stat' % self.process.pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            return None
+        # utime and stime, fields 14 and 15 of stat(5)
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+    def rss_bytes(self):
+        try:
+            with open('/proc/%i/statm' % self.process.pid) as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except IOError:
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def iter_jpegs(response):
+    """The JPEGs of a multipart stream as they arrive."""
+    buf = bytearray()
+    for chunk in response.iter_content(chunk_size=None):
+        buf += chunk
+        while True:
+            start = buf.find(SOI)
+            end = buf.find(EOI, start + 2) if start >= 0 else -1
+            if end < 0:
+                break
+            yield bytes(buf[start:end + 2])
+            del buf[:end + 2]
+
+
+class Viewer(threading.Thread):
+    """One streaming client counting the frames it gets in a time window
+    and, if stamped, their latency and index."""
+
+    def __init__(self, url, window, stamped=False):
+        super().__init__(name='viewer')
+        self.daemon = True
+        self.url = url
+        self.window = window  # (start, end) wall clock times
+        self.stamped = stamped
+        self.frames = 0
+        self.latencies = []
+        self.indexes = []
+        self.error = None
+
+    def run(self):
+        start, end = self.window
+        try:
+            response = requests.get(self.url, auth=(USERNAME, PASSWORD),
+                                    stream=True, timeout=(5, 30))
+            response.raise_for_status()
+            for jpeg in iter_jpegs(response):
+                now = time.time()
+                if now >= end:
+                    break
+                if now < start:
+                    continue
+                self.frames += 1
+                if self.stamped:
+                    img = cv2.imdecode(np.frombuffer(jpeg, np.uint8),
+                                       cv2.IMREAD_GRAYSCALE)
+                    index, millis = read_stamp(img)
+                    self.indexes.append(index)
+                    self.latencies.append(stamp_age(millis, now))
+            response.close()
+        except requests.RequestException as e:
+            self.error = str(e)
+
+
+def watch(urls, seconds, warmup=2.0, stamped=(0,)):
+    """Run a viewer per url for warmup + seconds, return them finished."""
+    start = time.time() + warmup
+    viewers = [Viewer(url, (start, start + seconds), i in stamped)
+               for i, url in enumerate(urls)]
+    for viewer in viewers:
+        viewer.start()
+    for viewer in viewers:
+        viewer.join(warmup + seconds + 30)
+    return viewers
+
+
+def _dropped(indexes):
+    if len(indexes) < 2:
+        return None
+    expected = max(indexes) - min(indexes) + 1
+    return round(1 - len(set(indexes)) / float(expected), 4)
+
+
+def bench_latency(server, args):
+    viewer = watch([server.url + '/video_feed'], args.seconds)[0]
+    return {
+        'fps': round(viewer.frames / float(args.seconds), 2),
+        'latency_ms': _percentiles(viewer.latencies, 1000),
+        'dropped': _dropped(viewer.indexes),
+        'error': viewer.error
+    }
+
+
+def bench_fanout(server, args):
+    results = []
+    for count in args.viewers:
+        cpu = server.cpu_seconds()
+        viewers = watch([server.url + '/video_feed'] * count, args.seconds)
+        cpu = server.cpu_seconds() - cpu if cpu is not None else None
+        fps = [viewer.frames / float(args.seconds) for viewer in viewers]
+        results.append({
+            'viewers': count,
+            'fps_mean': round(float(np.mean(fps)), 2),
+            'fps_min': round(float(np.min(fps)), 2),
+            'fps_p10': round(float(np.percentile(fps, 10)), 2),
+            'total_fps': round(float(np.sum(fps)), 2),
+            'latency_ms': _percentiles(viewers[0].latencies, 1000),
+            'dropped': _dropped(viewers[0].indexes),
+            'server_cpu_seconds': cpu,
+            'errors': sum(1 for viewer in viewers if viewer.error)
+        })
+    return results
+
+
+def bench_stream_detect(server, detector, args):
+    results = []
+    for rtt in args.rtts:
+        detector.rtt = rtt
+        requests_before = detector.requests
+        started = time.time()
+        viewer = watch([server.url + '/stream-detect'], args.seconds)[0]
+        detections = detector.requests - requests_before
+        results.append({
+            'detector_rtt_ms': rtt * 1000,
+            'stream_fps': round(viewer.frames / float(args.seconds), 2),
+            'detections_per_second': round(detections / (time.time() - started), 2),
+            'latency_ms': _percentiles(viewer.latencies, 1000),
+            'error': viewer.error
+        })
+    detector.rtt = 0
+    return results
+
+
+def bench_motion(args):
+    camera = ReplayCamera(fps=1000, size=args.size, stamped=False,
+                          name='motion-bench')
+    frames = camera.frames()
+    # the first frame only seeds the background
+    detector = MotionDetector()
+    detector.detect(next(frames))
+    count = args.motion_frames
+    sample = [next(frames) for _ in range(count)]
+    wall, cpu = time.time(), time.process_time()
+    regions = sum(len(detector.detect(frame)) for frame in sample)
+    wall, cpu = time.time() - wall, time.process_time() - cpu
+    return {
+        'frames': count,
+        'cpu_ms_per_frame': round(cpu / count * 1000, 3),
+        'wall_ms_per_frame': round(wall / count * 1000, 3),
+        'regions': regions
+    }
+
+
+def bench_memory(server, args):
+    """RSS of the server, sampled every second while a few viewers and a
+    detection stream run for args.soak seconds."""
+    samples = []
+    urls = [server.url + '/video_feed'] * 4 + [server.url + '/stream-detect']
+    done = threading.Event()
+
+    def sample():
+        started = time.time()
+        while not done.is_set():
+            rss = server.rss_bytes()
+            if rss is not None:
+                samples.append((time.time() - started, rss))
+            done.wait(1)
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    watch(urls, args.soak, warmup=0, stamped=())
+    done.set()
+    sampler.join()
+    if len(samples) < 2:
+        return None
+    times, rss = np.array(samples).T
+    return {
+        'seconds': args.soak,
+        'start_mb': round(rss[0] / 2.0 ** 20, 2),
+        'end_mb': round(rss[-1] / 2.0 ** 20, 2),
+        'max_mb': round(rss.max() / 2.0 ** 20, 2),
+        'growth_mb_per_minute': round(
+            float(np.polyfit(times, rss, 1)[0]) * 60 / 2.0 ** 20, 3)
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the end to end benchmarks')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated subset of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='measuring time of each run')
+    parser.add_argument('--fps', type=float, default=15, help='replay camera fps')
+    parser.add_argument('--size', default='640x480', help='replay camera resolution')
+    parser.add_argument('--viewers', default='1,10,50,100,200',
+                        help='/video_feed viewer counts of the fanout runs')
+    parser.add_argument('--rtts', default='0,0.05,0.2,0.5',
+                        help='detector round trip times in seconds')
+    parser.add_argument('--detect-cache-size', type=int, default=0,
+                        help='scenes the server caches detections for, '
+                             '0 to detect every frame')
+    parser.add_argument('--motion-frames', type=int, default=300)
+    parser.add_argument('--soak', type=float, default=60,
+                        help='duration of the memory run in seconds')
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('Unknown scenario "%s"' % scenario)
+    args.viewers = [int(v) for v in args.viewers.split(',')]
+    args.rtts = [float(v) for v in args.rtts.split(',')]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {
+        'meta': {
+            'time': time.time(),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'fps': args.fps,
+            'size': args.size,
+            'seconds': args.seconds,
+            'detect_cache_size': args.detect_cache_size
+        }
+    }
+
+    if 'motion' in args.scenarios:
+        results['motion'] = bench_motion(args)
+
+    served = [s for s in args.scenarios if s != 'motion']
+    if served:
+        detector = DetectorStub()
+        detector.start()
+        server = Server(detector.url, args.fps, args.size,
+                        args.detect_cache_size)
+        try:
+            server.wait_ready()
+            if 'latency' in served:
+                results['latency'] = bench_latency(server, args)
+            if 'fanout' in served:
+                results['fanout'] = bench_fanout(server, args)
+            if 'stream_detect' in served:
+                results['stream_detect'] = bench_stream_detect(server, detector, args)
+            if 'memory' in served:
+                results['memory'] = bench_memory(server, args)
+        finally:
+            server.stop()
+            detector.stop()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+"""Serves the app's HTTP routes on its own for the benchmarks.
+
+    python -m benchmarks.server PORT
+
+Unlike app.py it doesn't start the RTSP server, motion trackers or report
+worker, so what is measured is the HTTP serving paths. Nor does it import
+the RTSP server, so it runs without GStreamer.
+"""
+import sys
+import logging
+
+import app
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    app.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True,
+                use_reloader=False)
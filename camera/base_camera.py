@@ -1,123 +1,311 @@
+import os
 import time
+import asyncio
 import threading
 import logging
 
+from . import metrics
+
 logger = logging.getLogger()
 
-try:
-    from greenlet import getcurrent as get_ident
-except ImportError:
-    logger.info('Greenlet not installed using native threads')
-    try:
-        from thread import get_ident
-    except ImportError:
-        from _thread import get_ident
+FRAME_TIMEOUT = int(os.environ.get('FRAME_TIMEOUT_SECONDS', 10))
+# rate the camera idles at when no consumer asks for more, and the most it
+# is ever driven at (0 for as fast as the sensor goes)
+CAMERA_IDLE_FPS = float(os.environ.get('CAMERA_IDLE_FPS', 1))
+CAMERA_MAX_FPS = float(os.environ.get('CAMERA_MAX_FPS', 0))
+# the capture loop waits 1 / target_fps() between frames
+if not CAMERA_IDLE_FPS > 0:
+    raise ValueError('CAMERA_IDLE_FPS must be positive, got %s' % CAMERA_IDLE_FPS)
+if not CAMERA_MAX_FPS >= 0:
+    raise ValueError('CAMERA_MAX_FPS must be 0 or positive, got %s' % CAMERA_MAX_FPS)
+# how long a consumer's rate request lasts unless renewed
+FPS_DEMAND_SECONDS = 5
+FULL_RATE = float('inf')
+
+CAPTURE_SECONDS = metrics.Histogram(
+    'camera_capture_seconds', 'Time the backend took to produce a frame',
+    ['camera'])
+FRAMES = metrics.Counter('camera_frames_total', 'Frames published', ['camera'])
+FRAME_WAIT_SECONDS = metrics.Histogram(
+    'camera_frame_wait_seconds', 'Time clients waited for a new frame',
+    ['camera'])
+FRAMES_SKIPPED = metrics.Counter(
+    'camera_frames_skipped_total',
+    'Frames published while a client was busy, so it never read them',
+    ['camera'])
+CAMERA_FPS = metrics.Gauge('camera_fps', 'Smoothed capture rate', ['camera'])
+CAMERA_TARGET_FPS = metrics.Gauge(
+    'camera_target_fps', 'Rate the capture loop is paced at', ['camera'])
+
+
+class FrameBroadcast(object):
+    """Signals all active clients when a new frame is available.
 
+    The camera thread bumps a sequence number and notifies a single
+    condition, each client waits until the sequence has moved past the last
+    frame it handled. Nothing is kept per client, so publishing costs the
+    same with one viewer or hundreds and clients that go away need no
+    cleanup.
 
-class CameraEvent(object):
-    """An Event-like class that signals all active clients when a new frame is
-    available.
+    Coroutines wait with wait_async() instead. All the coroutines of one
+    event loop share a single future, so a publish costs one callback per
+    loop however many of them are waiting.
     """
 
     def __init__(self):
-        self.events = {}
-
-    def wait(self):
-        """Invoked from each client's thread to wait for the next frame."""
-        ident = get_ident()
-        if ident not in self.events:
-            # this is a new client
-            # add an entry for it in the self.events dict
-            # each entry has two elements, a threading.Event() and a timestamp
-            self.events[ident] = [threading.Event(), time.time()]
-        return self.events[ident][0].wait()
-
-    def set(self):
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.frame = None
+        self.futures = {}  # event loop -> future resolved on the next publish
+
+    def publish(self, frame):
         """Invoked by the camera thread when a new frame is available."""
-        now = time.time()
-        remove = None
-        for ident, event in self.events.items():
-            if not event[0].isSet():
-                # if this client's event is not set, then set it
-                # also update the last set timestamp to now
-                event[0].set()
-                event[1] = now
-            else:
-                # if the client's event is already set, it means the client
-                # did not process a previous frame
-                # if the event stays set for more than 5 seconds, then assume
-                # the client is gone and remove it
-                if now - event[1] > 5:
-                    remove = ident
-        if remove:
-            del self.events[remove]
-
-    def clear(self):
-        """Invoked from each client's thread after a frame was processed."""
-        self.events[get_ident()][0].clear()
+        with self.condition:
+            self.seq += 1
+            frame.seq = self.seq
+            self.frame = frame
+            self.condition.notify_all()
+            futures, self.futures = self.futures, {}
+        for loop, future in futures.items():
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # the loop was closed
+                pass
+
+    def wait(self, after=None, timeout=None):
+        """Invoked from each client's thread to wait for a frame newer than
+        sequence number `after` (by default, the next frame published).
+
+        Returns None if the timeout expires first.
+        """
+        with self.condition:
+            if after is None:
+                after = self.seq
+            if not self.condition.wait_for(lambda: self.seq > after,
+                                           timeout):
+                return None
+            return self.frame
+
+    async def wait_async(self, after=None, timeout=None):
+        """wait() for coroutines."""
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self.condition:
+                if after is None:
+                    after = self.seq
+                if self.seq > after:
+                    return self.frame
+                future = self.futures.get(loop)
+                if future is None:
+                    future = self.futures[loop] = loop.create_future()
+            remaining = None if deadline is None else deadline - loop.time()
+            # asyncio.wait() leaves the shared future alone when this waiter
+            # times out or is cancelled, unlike wait_for()
+            await asyncio.wait([future], timeout=remaining)
+            if not future.done():
+                return None
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
 
 
 class BaseCamera(object):
-    thread = None  # background thread that reads frames from camera
-    frame = None  # current frame is stored here by background thread
-    img = None
-    last_access = 0  # time of last client access to the camera
-    event = CameraEvent()
-    has_shutdown = False
+    """A camera source with its own background capture thread.
 
-    def __init__(self):
+    Every instance keeps its own state, so one process can drive several
+    cameras; camera.registry hands out one instance per camera id.
+    """
+    # backends whose frames() already arrive at target_fps() (e.g. captured
+    # by another process) set this so the camera thread doesn't pace them
+    # again and add up to a frame interval of latency
+    self_paced = False
+
+    def __init__(self, source=None, name='default'):
+        self.source = source
+        self.name = name
+        self.thread = None  # background thread that reads frames from camera
+        self.last_access = 0  # time of last client access to the camera
+        self.broadcast = FrameBroadcast()  # current Frame is published here
+        self.has_shutdown = False
+        self.lock = threading.Lock()
+        self.listeners = []  # called from the camera thread with each frame
+        self.fps = 0.0  # smoothed rate frames are actually captured at
+        self.demands = {}  # requested fps -> time the request lapses
+        self.demand_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self._capture_seconds = CAPTURE_SECONDS.labels(name)
+        self._frames = FRAMES.labels(name)
+        self._frame_wait_seconds = FRAME_WAIT_SECONDS.labels(name)
+        self._frames_skipped = FRAMES_SKIPPED.labels(name)
+        CAMERA_FPS.labels(name).set_function(lambda: self.fps)
+        CAMERA_TARGET_FPS.labels(name).set_function(self.target_fps)
+
+    def start(self):
         """Start the background camera thread if it isn't running yet."""
-        if BaseCamera.thread is None:
-            BaseCamera.last_access = time.time()
+        with self.lock:
+            if self.thread is None:
+                self.last_access = time.time()
+                self.has_shutdown = False
 
-            # start background frame thread
-            BaseCamera.thread = threading.Thread(target=self._thread)
-            BaseCamera.thread.start()
+                # start background frame thread
+                self.thread = threading.Thread(
+                    target=self._thread, name='camera-%s' % self.name)
+                self.thread.daemon = True
+                self.thread.start()
 
-            # wait until frames are available
-            while self.get_frame() is None:
-                time.sleep(0)
+    def add_listener(self, callback):
+        """Have the camera thread call callback(frame) for every frame it
+        publishes, for consumers that want frames pushed to them.
 
-    def get_frame(self):
-        """Return the current camera frame."""
-        BaseCamera.last_access = time.time()
+        Callbacks run on the capture thread so they must not block, and the
+        camera keeps running for as long as any are registered.
+        """
+        with self.lock:
+            self.listeners = self.listeners + [callback]
+        self.start()
+
+    def remove_listener(self, callback):
+        with self.lock:
+            self.listeners = [listener for listener in self.listeners
+                              if listener != callback]
+
+    def request_fps(self, fps):
+        """Ask for frames at fps (FULL_RATE for as fast as possible) for the
+        next FPS_DEMAND_SECONDS.
+
+        The capture loop runs at the highest rate currently requested and
+        drops to CAMERA_IDLE_FPS when nobody asks for more. Only one entry
+        is kept per distinct rate, not per consumer.
+        """
+        now = time.time()
+        faster = self.demands.get(fps, 0) <= now and fps > self.target_fps()
+        with self.demand_lock:
+            for rate, until in list(self.demands.items()):
+                if until <= now:
+                    del self.demands[rate]
+            self.demands[fps] = now + FPS_DEMAND_SECONDS
+        if faster:
+            self.wake()
+
+    def wake(self):
+        """Cut the capture loop's wait short, the next frame is wanted
+        now."""
+        self.wakeup.set()
+
+    def target_fps(self):
+        """The rate the capture loop is currently paced at."""
+        now = time.time()
+        rates = [fps for fps, until in list(self.demands.items()) if until > now]
+        fps = max(rates) if rates else CAMERA_IDLE_FPS
+        if CAMERA_MAX_FPS:
+            fps = min(fps, CAMERA_MAX_FPS)
+        return fps
+
+    def get_frame(self, after=None, fps=None):
+        """Return the next camera Frame.
+
+        Clients reading frames in a loop should pass the seq of the last
+        frame they handled as `after`, a newer frame that was published
+        meanwhile is then returned straight away instead of waiting for the
+        one after it, and the rate they need frames at as `fps` (see
+        request_fps). One off reads leave fps out and have the next frame
+        captured straight away. Views such as frame.jpeg() or frame.gray()
+        are computed on demand and shared by every client reading the same
+        frame.
+
+        The camera thread is (re)started if it isn't running.
+        """
+        after = self._demand(after, fps)
 
         # wait for a signal from the camera thread
-        BaseCamera.event.wait()
-        BaseCamera.event.clear()
+        waited = time.time()
+        frame = self.broadcast.wait(after, timeout=FRAME_TIMEOUT)
+        return self._received(frame, after, waited)
+
+    async def get_frame_async(self, after=None, fps=None):
+        """get_frame() for coroutines, waits without holding a thread."""
+        after = self._demand(after, fps)
+        waited = time.time()
+        frame = await self.broadcast.wait_async(after, timeout=FRAME_TIMEOUT)
+        return self._received(frame, after, waited)
+
+    def _demand(self, after, fps):
+        self.last_access = time.time()
+        if fps is None:
+            self.wake()
+        else:
+            self.request_fps(fps)
+        if self.thread is None:
+            if after is None:
+                after = self.broadcast.seq
+            self.start()
+        return after
 
-        return BaseCamera.img, BaseCamera.frame
+    def _received(self, frame, after, waited):
+        self._frame_wait_seconds.observe(time.time() - waited)
+        if frame is None:
+            raise IOError('No frame from camera %s in %i seconds' %
+                          (self.name, FRAME_TIMEOUT))
+        if after is not None and frame.seq > after + 1:
+            self._frames_skipped.inc(frame.seq - after - 1)
+        return frame
 
-    @staticmethod
-    def frames():
-        """"Generator that returns frames from the camera."""
+    def frames(self):
+        """"Generator that returns camera.frame.Frame objects from the
+        camera."""
         raise RuntimeError('Must be implemented by subclasses.')
 
-    @staticmethod
-    def shutdown():
+    def shutdown(self):
         raise RuntimeError('Must be implemented by subclasses.')
 
-    @classmethod
-    def _thread(cls):
+    def _thread(self):
         """Camera background thread."""
-        logger.info('Starting camera thread.')
-        frames_iterator = cls.frames()
-        for img, frame in frames_iterator:
-            BaseCamera.frame = frame
-            BaseCamera.img = img
-            BaseCamera.event.set()  # send signal to clients
-            time.sleep(0)
-
-            # if there hasn't been any clients asking for frames in
-            # the last 10 seconds then stop the thread
-            if time.time() - BaseCamera.last_access > 10:
-                frames_iterator.close()
-                logger.info('Stopping camera thread due to inactivity.')
-                if hasattr(cls, 'needs_shutdown'):
-                    logger.info('Calling %s subclass shutdown' % str(cls))
-                    cls.shutdown()
-                else:
-                    logger.info('No safe shutdown method flag found')
-                BaseCamera.has_shutdown = True
-                break
-        BaseCamera.thread = None
+        logger.info('Starting camera thread for %s.', self.name)
+        frames_iterator = self.frames()
+        last_timestamp = None
+        resumed = None  # when the backend was last asked for a frame
+        try:
+            for frame in frames_iterator:
+                started = time.time()
+                self.wakeup.clear()
+                if resumed is not None:
+                    self._capture_seconds.observe(started - resumed)
+                self._frames.inc()
+                if last_timestamp is not None and frame.timestamp > last_timestamp:
+                    rate = 1.0 / (frame.timestamp - last_timestamp)
+                    self.fps = rate if not self.fps else 0.9 * self.fps + 0.1 * rate
+                last_timestamp = frame.timestamp
+
+                self.broadcast.publish(frame)  # send signal to clients
+                for listener in self.listeners:
+                    try:
+                        listener(frame)
+                    except Exception as e:
+                        logger.exception(e)
+
+                # pace the loop to the fastest consumer, a request for a
+                # higher rate cuts the wait short
+                if not self.self_paced:
+                    interval = 1.0 / self.target_fps()
+                    self.wakeup.wait(max(0, interval - (time.time() - started)))
+                resumed = time.time()
+
+                # if there hasn't been any clients asking for frames in
+                # the last 10 seconds then stop the thread
+                if not self.listeners and time.time() - self.last_access > 10:
+                    frames_iterator.close()
+                    logger.info('Stopping camera thread for %s due to inactivity.',
+                                self.name)
+                    if getattr(self, 'needs_shutdown', False):
+                        logger.info('Calling %s subclass shutdown' % str(self))
+                        self.shutdown()
+                    else:
+                        logger.info('No safe shutdown method flag found')
+                    self.has_shutdown = True
+                    break
+        finally:
+            self.thread = None
@@ -4,122 +4,254 @@ import time
 import logging
 
 import serial
-import cv2
-import numpy as np
 
 from .base_camera import BaseCamera
+from .frame import Frame
 
 logger = logging.getLogger()
 
 FLUSH_TIMEOUT = int(os.environ.get('SERIAL_FLUSH_TIMEOUT', 5))
 ACK_STRING = 'ACK CMD SPI interface OK'
+# largest JPEG a frame may be, the read buffer is allocated once at this size
+ARDUCAM_MAX_FRAME_BYTES = int(os.environ.get('ARDUCAM_MAX_FRAME_BYTES', 512 * 1024))
+# how long a snap may take from command to the end of the image
+ARDUCAM_FRAME_TIMEOUT = float(os.environ.get('ARDUCAM_FRAME_TIMEOUT', 2))
+ARDUCAM_RETRIES = int(os.environ.get('ARDUCAM_RETRIES', 5))
+ARDUCAM_RESOLUTION = os.environ.get('ARDUCAM_RESOLUTION', '640x480')
+# timeout of a single blocking serial read
+READ_TIMEOUT = .2
+FPS_LOG_SECONDS = 60
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
 
 
 class ArduCamCases(object):
     TAKE_PICTURE = 16
     SET_640x480 = 4
+    # OV2640 resolution switch commands
+    RESOLUTIONS = {
+        '160x120': 0,
+        '176x144': 1,
+        '320x240': 2,
+        '352x288': 3,
+        '640x480': 4,
+        '800x600': 5,
+        '1024x768': 6,
+        '1280x1024': 7,
+        '1600x1200': 8
+    }
+
+
+class SerialFrameReader(object):
+    """Incremental reader of the ArduCam serial protocol.
+
+    Bytes are read into one preallocated buffer as they arrive, ACK lines
+    are split off at their newline and JPEGs are framed by their SOI/EOI
+    markers, so an image is complete exactly when its last byte is in
+    rather than when the port happens to go quiet. Reads block until data
+    arrives (up to the port timeout) instead of sleeping between polls.
+    """
+
+    def __init__(self, port, max_bytes=ARDUCAM_MAX_FRAME_BYTES):
+        self.port = port
+        self.buffer = bytearray(max_bytes)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unparsed byte
+        self.end = 0  # end of the bytes read so far
+
+    def reset(self):
+        """Drop everything buffered, here and in the port."""
+        self.start = self.end = 0
+        self.port.reset_input_buffer()
+
+    def _fill(self, deadline):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if not self.start:
+                raise IOError('ArduCam frame larger than %i bytes' % len(self.buffer))
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if time.time() > deadline:
+            raise IOError('Timed out reading from ArduCam')
+        # block for at least one byte, then take whatever else is waiting
+        size = min(max(1, self.port.in_waiting), len(self.buffer) - self.end)
+        self.end += self.port.readinto(self.view[self.end:self.end + size])
+
+    def read_line(self, deadline):
+        """Return the next line without its line ending."""
+        scanned = self.start
+        while True:
+            newline = self.buffer.find(b'\n', scanned, self.end)
+            if newline >= 0:
+                line = bytes(self.view[self.start:newline]).rstrip(b'\r')
+                self.start = newline + 1
+                return line
+            scanned = self.end - self.start
+            self._fill(deadline)
+            scanned += self.start
+
+    def read_jpeg(self, deadline):
+        """Return the next JPEG, skipping anything before its SOI marker."""
+        while True:
+            soi = self.buffer.find(SOI, self.start, self.end)
+            if soi >= 0:
+                self.start = soi
+                break
+            # keep a trailing 0xff, it may be the first half of the marker
+            self.start = max(self.start, self.end - 1)
+            self._fill(deadline)
+
+        scanned = self.start + len(SOI)
+        while True:
+            eoi = self.buffer.find(EOI, scanned, self.end)
+            if eoi >= 0:
+                jpeg = bytes(self.view[self.start:eoi + len(EOI)])
+                self.start = eoi + len(EOI)
+                return jpeg
+            scanned = max(scanned, self.end - 1) - self.start
+            self._fill(deadline)
+            scanned += self.start
 
 
 class Camera(BaseCamera):
     port_source = os.environ.get('SERIAL_PORT', '/dev/ttyACM0')
     BAUD_RATE = int(os.environ.get('BAUD_RATE', 921600))
     needs_shutdown = True
-    serial_port = None
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, source=None, resolution=ARDUCAM_RESOLUTION, **kwargs):
+        super().__init__(source or Camera.port_source, **kwargs)
+        if resolution not in ArduCamCases.RESOLUTIONS:
+            raise ValueError('Unsupported ARDUCAM_RESOLUTION "%s", expected one of %s' % (
+                resolution, ', '.join(sorted(ArduCamCases.RESOLUTIONS,
+                                             key=ArduCamCases.RESOLUTIONS.get))))
+        self.resolution = resolution
+        self.serial_port = None
+        self.reader = None
+        self.snap_requested = False  # a TAKE_PICTURE is already on its way
+        self.snap_seconds = 0.0  # smoothed time from snap command to image
 
-    @staticmethod
-    def set_video_source(source):
-        Camera.video_source = source
+    def set_video_source(self, source):
+        self.source = source
 
-    @staticmethod
-    def shutdown():
-        Camera.serial_port.close()
-        Camera.serial_port = None
-        logger.info('ArduCam serial port closed')
+    def shutdown(self):
+        self.serial_port.close()
+        self.serial_port = None
+        self.reader = None
+        self.snap_requested = False
+        logger.info('ArduCam serial port %s closed', self.source)
 
-    @staticmethod
-    def frames():
-        if not Camera.serial_port:
-            serial_port = serial.Serial(Camera.port_source,
+    def frames(self):
+        if not self.serial_port:
+            serial_port = serial.Serial(self.source,
                                         Camera.BAUD_RATE,
-                                        timeout=2)
-            Camera.serial_port = serial_port
+                                        timeout=READ_TIMEOUT)
+            self.serial_port = serial_port
+            self.reader = SerialFrameReader(serial_port)
             logger.info("Serial port state is {0}".format(
                 'closed' if serial_port.closed else 'open'))
-            time.sleep(.3)
-            if serial_port.in_waiting:
-                line = serial_port.readline()
-                if line == b'ACK CMD ArduCAM Start!\r\n':
-                    logger.info('>>> %s' % line)
-                elif line == b'ACK CMD SPI interface OK.\r\n':
-                    logger.info('>>> %s' % line)
-                elif line == b'ACK CMD OV2640 detected.\r\n':
-                    logger.info('>>> %s' % line)
-                else:
-                    logger.info(
-                        'Could not match "%s", so flushing the input buffer' % line)
-                    Camera.reset_buffers()
-            serial_port.write([ArduCamCases.SET_640x480])
-            time.sleep(.3)
-            if not serial_port.in_waiting:
-                # wait
-                serial_port.write([ArduCamCases.SET_640x480])
-                time.sleep(.2)
-            while serial_port.in_waiting:
-                line = serial_port.readline()
-                if line != b'ACK CMD switch to OV2640_640x480\r\n':
-                    raise ValueError("Expected ACK switch to OV2640_640x480")
-                else:
-                    logger.info("Resolution switch acknowledged (%s)" % line)
-        return Camera._being_processing()
-
-    @staticmethod
-    def reset_buffers():
-        while Camera.serial_port.in_waiting:
-            Camera.serial_port.reset_input_buffer()
-        while Camera.serial_port.out_waiting:
-            Camera.serial_port.reset_output_buffer()
-
-    @staticmethod
-    def _fetch_image():
-        buf = b''
-        Camera.serial_port.write([ArduCamCases.TAKE_PICTURE])
-        time.sleep(.5)
-        logger.info('Starting to read bytes...')
-        while not Camera.serial_port.in_waiting:
-            logger.info(
-                'Camera not responding, sending snap command and sleeping')
-            Camera.serial_port.write([ArduCamCases.TAKE_PICTURE])
-            time.sleep(.2)
+            self._read_banner()
+            self._set_resolution()
+        return self._being_processing()
 
+    def _read_banner(self):
+        """Log the start up lines the ArduCam prints, until it goes quiet."""
         while True:
-            if Camera.serial_port.in_waiting:
-                line = Camera.serial_port.readline()
-                if line == b'ACK CMD CAM start single shot.\r\n':
-                    continue
-                elif line == b'ACK CMD CAM Capture Done.\r\n':
-                    continue
-                elif line == b'ACK IMG\r\n':
-                    break
-                else:
-                    logger.info(
-                        "Didn't expect %s here, resetting buffers and trying again" % line)
-                    return Camera._fetch_image()
+            try:
+                line = self.reader.read_line(time.time() + READ_TIMEOUT)
+            except IOError:
+                return
+            if line.startswith(b'ACK CMD'):
+                logger.info('>>> %s' % line)
             else:
-                time.sleep(.1)
-        while Camera.serial_port.in_waiting:
-            buf += Camera.serial_port.read(Camera.serial_port.in_waiting)
-            time.sleep(.1)
-        logger.info(
-            'Snap command output consumed got image of byte length %i' % len(buf))
-        return buf
-
-    @staticmethod
-    def _being_processing():
-        logger.info('Begin processing ArduCam')
+                logger.info(
+                    'Could not match "%s", so flushing the input buffer' % line)
+                self.reset_buffers()
+                return
+
+    def _set_resolution(self):
+        expected = ('ACK CMD switch to OV2640_' + self.resolution).encode()
+        for attempt in range(ARDUCAM_RETRIES):
+            self.serial_port.write([ArduCamCases.RESOLUTIONS[self.resolution]])
+            try:
+                line = self.reader.read_line(time.time() + ARDUCAM_FRAME_TIMEOUT)
+            except IOError as e:
+                logger.info('No answer to the resolution switch: %s', e)
+                continue
+            if line != expected:
+                logger.info('Expected "%s" but got "%s", trying again',
+                            expected, line)
+                self.reset_buffers()
+                continue
+            logger.info("Resolution switch acknowledged (%s)" % line)
+            return
+        raise IOError('ArduCam did not acknowledge the switch to %s' % self.resolution)
+
+    def reset_buffers(self):
+        self.snap_requested = False
+        self.reader.reset()
+        self.serial_port.reset_output_buffer()
+
+    def _pipelined(self):
+        """Whether to ask for the next picture before this one is read.
+
+        Worth it when frames are wanted at least as fast as a snap takes,
+        the ArduCam then captures the next picture while this one is still
+        being transferred. At lower rates it would only hand out a stale
+        picture later.
+        """
+        return 1.0 / self.target_fps() <= self.snap_seconds * 1.5
+
+    def _snap(self):
+        """Take one picture and return its JPEG, IOError on any protocol
+        error or timeout."""
+        started = time.time()
+        deadline = started + ARDUCAM_FRAME_TIMEOUT
+        # a pipelined snap started before we got here, it isn't timed
+        timed = not self.snap_requested
+        if timed:
+            self.serial_port.write([ArduCamCases.TAKE_PICTURE])
+        self.snap_requested = False
+        while True:
+            line = self.reader.read_line(deadline)
+            if line == b'ACK IMG':
+                if self._pipelined():
+                    # queued on the ArduCam until this transfer is done
+                    self.serial_port.write([ArduCamCases.TAKE_PICTURE])
+                    self.snap_requested = True
+                jpeg = self.reader.read_jpeg(deadline)
+                if timed:
+                    seconds = time.time() - started
+                    self.snap_seconds = seconds if not self.snap_seconds else \
+                        0.9 * self.snap_seconds + 0.1 * seconds
+                return jpeg
+            elif not line.startswith(b'ACK CMD'):
+                # e.g. "CAM start single shot" and "CAM Capture Done"
+                raise IOError("Didn't expect %s here" % line)
+
+    def _fetch_image(self):
+        for attempt in range(ARDUCAM_RETRIES):
+            try:
+                buf = self._snap()
+            except IOError as e:
+                logger.info('%s, resetting buffers and trying again', e)
+                self.reset_buffers()
+                continue
+            logger.debug('Snap command output consumed got image of byte length %i',
+                         len(buf))
+            return buf
+        raise IOError('ArduCam gave no image after %i attempts' % ARDUCAM_RETRIES)
+
+    def _being_processing(self):
+        logger.info('Begin processing ArduCam at %s', self.resolution)
+        logged = time.time()
         while True:
-            buf = Camera._fetch_image()
-            image = np.fromstring(buf, dtype=np.uint8)
-            yield cv2.imencode('.jpg', image)[1], image
+            if time.time() - logged > FPS_LOG_SECONDS:
+                logger.info('ArduCam %s at %.1f fps, %.0f ms per snap',
+                            self.name, self.fps, self.snap_seconds * 1000)
+                logged = time.time()
+            # the camera already sends JPEG, it is only decoded if a client
+            # asks for raw pixels
+            yield Frame(jpeg=self._fetch_image())
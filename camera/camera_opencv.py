@@ -2,26 +2,37 @@ import os
 
 import cv2
 from .base_camera import BaseCamera
+from .frame import Frame
 
 
 class Camera(BaseCamera):
     video_source = os.environ.get('VIDEO_PATH', 0)
 
-    @staticmethod
-    def set_video_source(source):
-        Camera.video_source = source
+    def __init__(self, source=None, **kwargs):
+        if source is None:
+            source = Camera.video_source
+        # device indexes come through the environment as strings
+        if isinstance(source, str) and source.isdigit():
+            source = int(source)
+        super().__init__(source, **kwargs)
 
-    @staticmethod
-    def frames():
-        camera = cv2.VideoCapture(Camera.video_source)
+    def set_video_source(self, source):
+        self.source = source
+
+    def frames(self):
+        camera = cv2.VideoCapture(self.source)
         camera.set(cv2.CAP_PROP_FRAME_COUNT, 1)
+        # the loop can be paced well below the sensor rate, a deep driver
+        # queue would then hand out frames seconds old
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
         if not camera.isOpened():
-            raise IOError('Failed to read camera')
+            raise IOError('Failed to read camera %s' % self.name)
 
         while True:
-            # read current frame
-            _, img = camera.read()
-
-            # encode as a jpeg image and return it
-            yield img, cv2.imencode('.jpg', img)[1]
+            # read current frame, encoding is left to the clients that need it
+            ok, img = camera.read()
+            if not ok:
+                # end of a VIDEO_PATH file, use the replay camera to loop one
+                raise IOError('No more frames from camera %s' % self.name)
+            yield Frame(bgr=img)
@@ -1,23 +1,138 @@
-import io
+"""Raspberry Pi camera backend.
+
+The GPU encodes full resolution JPEGs on splitter port 1, which are passed
+to HTTP clients untouched, and resizes the same frames to PI_PREVIEW_SIZE
+BGR on splitter port 2 for motion analysis and the RTSP substream. Neither
+path decodes or encodes on the CPU; only consumers asking for full
+resolution pixels (the main RTSP stream, detection drawing) decode the JPEG,
+set PI_PREVIEW_SIZE to PI_RESOLUTION to avoid that too at the cost of
+memory bandwidth.
+"""
+import os
 import time
+import logging
+import threading
+
+import numpy as np
 import picamera
+
 from .base_camera import BaseCamera
+from .frame import Frame, parse_size
+
+logger = logging.getLogger()
+
+PI_RESOLUTION = os.environ.get('PI_RESOLUTION', '640x480')
+PI_FRAMERATE = int(os.environ.get('PI_FRAMERATE', 30))
+PI_PREVIEW_SIZE = os.environ.get('PI_PREVIEW_SIZE', '320x240')
+PI_JPEG_QUALITY = int(os.environ.get('PI_JPEG_QUALITY', 85))
+# how long without a frame from the GPU before giving up
+PI_FRAME_TIMEOUT = 5
+
+EOI = b'\xff\xd9'
+
+
+class _JpegOutput(object):
+    """Collects the MJPEG encoder's writes into whole JPEGs."""
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.chunks = []
+
+    def write(self, buf):
+        self.chunks.append(buf)
+        if buf.endswith(EOI):
+            jpeg = self.chunks[0] if len(self.chunks) == 1 else b''.join(self.chunks)
+            self.chunks = []
+            self.camera._put_jpeg(jpeg)
+        return len(buf)
+
+    def flush(self):
+        self.chunks = []
+
+
+class _PreviewOutput(object):
+    """Turns the raw BGR writes of the resizer port into arrays.
+
+    The GPU pads rows to 32 pixels and the height to 16, the array is a view
+    of the bytes picamera hands over with the padding sliced off, so no
+    pixel is copied. Frames split over several writes are assembled in one
+    preallocated buffer.
+    """
+
+    def __init__(self, camera, size):
+        self.camera = camera
+        self.width, self.height = size
+        self.padded = ((self.height + 15) // 16 * 16, (self.width + 31) // 32 * 32, 3)
+        self.frame_bytes = self.padded[0] * self.padded[1] * 3
+        self.partial = bytearray(self.frame_bytes)
+        self.filled = 0
+
+    def write(self, buf):
+        if not self.filled and len(buf) == self.frame_bytes:
+            data = buf
+        else:
+            size = min(len(buf), self.frame_bytes - self.filled)
+            self.partial[self.filled:self.filled + size] = buf[:size]
+            self.filled += size
+            if self.filled < self.frame_bytes:
+                return len(buf)
+            data = bytes(self.partial)
+            self.filled = 0
+        array = np.frombuffer(data, dtype=np.uint8).reshape(self.padded)
+        self.camera._put_preview(array[:self.height, :self.width])
+        return len(buf)
+
+    def flush(self):
+        self.filled = 0
 
 
 class Camera(BaseCamera):
-    @staticmethod
-    def frames():
-        with picamera.PiCamera() as camera:
+    def __init__(self, source=None, **kwargs):
+        super().__init__(source, **kwargs)
+        self.resolution = parse_size(PI_RESOLUTION)
+        self.preview_size = parse_size(PI_PREVIEW_SIZE)
+        self.condition = threading.Condition()
+        self.jpeg = None
+        self.jpeg_time = None
+        self.jpeg_count = 0
+        self.preview = None
+
+    def _put_jpeg(self, jpeg):
+        with self.condition:
+            self.jpeg = jpeg
+            self.jpeg_time = time.time()
+            self.jpeg_count += 1
+            self.condition.notify_all()
+
+    def _put_preview(self, preview):
+        # read alongside the next JPEG, both ports see the same frames
+        self.preview = preview
+
+    def frames(self):
+        width, height = self.resolution
+        # the source selects the CSI port on boards with more than one
+        with picamera.PiCamera(camera_num=int(self.source or 0),
+                               resolution=self.resolution,
+                               framerate=PI_FRAMERATE) as camera:
             # let camera warm up
             time.sleep(2)
 
-            stream = io.BytesIO()
-            for _ in camera.capture_continuous(stream, 'jpeg',
-                                                 use_video_port=True):
-                # return current frame
-                stream.seek(0)
-                yield stream.read()
-
-                # reset stream for next frame
-                stream.seek(0)
-                stream.truncate()
+            camera.start_recording(_JpegOutput(self), format='mjpeg',
+                                   splitter_port=1, quality=PI_JPEG_QUALITY)
+            camera.start_recording(_PreviewOutput(self, self.preview_size),
+                                   format='bgr', splitter_port=2,
+                                   resize=self.preview_size)
+            try:
+                seen = 0
+                while True:
+                    with self.condition:
+                        if self.jpeg_count == seen and not self.condition.wait_for(
+                                lambda: self.jpeg_count != seen, PI_FRAME_TIMEOUT):
+                            raise IOError('No frame from Pi camera %s' % self.name)
+                        seen = self.jpeg_count
+                        jpeg, timestamp = self.jpeg, self.jpeg_time
+                    yield Frame(jpeg=jpeg, timestamp=timestamp,
+                                preview=self.preview, shape=(height, width, 3))
+            finally:
+                camera.stop_recording(splitter_port=2)
+                camera.stop_recording(splitter_port=1)
@@ -0,0 +1,191 @@
+"""Replay camera for testing without hardware.
+
+Loops a video file, a directory of JPEGs or, with no source, generated
+frames (a gradient with a bouncing block, so motion detection has something
+to find) at exactly REPLAY_FPS frames a second and REPLAY_SIZE resolution.
+Frames are produced on a fixed schedule like a real sensor: when the camera
+loop is paced slower than REPLAY_FPS the frames in between are skipped, and
+a frame's timestamp is the tick it was due at.
+
+With REPLAY_STAMP each frame carries its index and capture time as two rows
+of black and white blocks across the top, sized relative to the frame width
+so read_stamp() can recover them from any scaled or recompressed copy a
+client receives, e.g. to measure latency and dropped frames end to end.
+"""
+import os
+import time
+import logging
+
+import cv2
+import numpy as np
+
+from .base_camera import BaseCamera
+from .frame import Frame, parse_size
+
+logger = logging.getLogger()
+
+REPLAY_FPS = float(os.environ.get('REPLAY_FPS', 15))
+REPLAY_SIZE = os.environ.get('REPLAY_SIZE', '640x480')
+# off by default, the stamp changes every frame so motion detection would
+# see motion in it all the time
+REPLAY_STAMP = os.environ.get('REPLAY_STAMP', 'False') == 'True'
+
+STAMP_BITS = 32
+# the stamp spans STAMP_BITS of STAMP_COLUMNS block widths of the frame
+STAMP_COLUMNS = 40
+
+
+def stamp(img, index, timestamp):
+    """Draw index and timestamp (in ms, modulo 2**32) into img in place."""
+    block = img.shape[1] / float(STAMP_COLUMNS)
+    millis = int(timestamp * 1000) & 0xffffffff
+    for row, value in enumerate((index & 0xffffffff, millis)):
+        top, bottom = int(row * block), int((row + 1) * block)
+        for bit in range(STAMP_BITS):
+            left, right = int(bit * block), int((bit + 1) * block)
+            img[top:bottom, left:right] = 255 if value >> bit & 1 else 0
+
+
+def read_stamp(img):
+    """Return the (index, millis) stamped into img, a BGR or gray array."""
+    block = img.shape[1] / float(STAMP_COLUMNS)
+    values = []
+    for row in range(2):
+        y = int((row + 0.5) * block)
+        value = 0
+        for bit in range(STAMP_BITS):
+            if np.mean(img[y, int((bit + 0.5) * block)]) > 127:
+                value |= 1 << bit
+        values.append(value)
+    return tuple(values)
+
+
+def stamp_age(millis, now=None):
+    """Seconds since a stamped capture time."""
+    now = time.time() if now is None else now
+    return ((int(now * 1000) - millis) & 0xffffffff) / 1000.0
+
+
+class _SyntheticSource(object):
+    def __init__(self, size):
+        width, height = size
+        self.size = size
+        gradient = np.linspace(40, 200, width, dtype=np.uint8)
+        self.background = np.dstack([
+            np.tile(gradient, (height, 1)),
+            np.tile(gradient[::-1], (height, 1)),
+            np.full((height, width), 90, np.uint8)])
+        self.block = max(8, width // 8)
+
+    def read(self, index):
+        width, height = self.size
+        img = self.background.copy()
+        # bounce a block around the frame
+        x = _bounce(index * 4, width - self.block)
+        y = _bounce(index * 3, height - self.block)
+        img[y:y + self.block, x:x + self.block] = (30, 30, 230)
+        return img
+
+
+def _bounce(position, span):
+    position %= 2 * span
+    return position if position < span else 2 * span - position
+
+
+class _DirectorySource(object):
+    """The JPEGs of a directory in name order, decoded and resized once."""
+
+    def __init__(self, path, size):
+        names = sorted(name for name in os.listdir(path)
+                       if name.lower().endswith(('.jpg', '.jpeg')))
+        if not names:
+            raise IOError('No JPEG files in %s' % path)
+        self.images = []
+        for name in names:
+            img = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+            if img is None:
+                logger.warning('Skipping unreadable replay image %s', name)
+                continue
+            self.images.append(cv2.resize(img, size, interpolation=cv2.INTER_AREA))
+        if not self.images:
+            raise IOError('No readable JPEG files in %s' % path)
+        logger.info('Replaying %i images from %s', len(self.images), path)
+
+    def read(self, index):
+        return self.images[index % len(self.images)].copy()
+
+
+class _VideoSource(object):
+    """A video file decoded in order, reopened at the end to loop it."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.capture = None
+        self.position = 0  # index of the next frame the capture returns
+
+    def _open(self):
+        if self.capture is not None:
+            self.capture.release()
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise IOError('Failed to open replay video %s' % self.path)
+
+    def _grab(self):
+        if self.capture is None or not self.capture.grab():
+            self._open()
+            if not self.capture.grab():
+                raise IOError('Replay video %s has no frames' % self.path)
+        self.position += 1
+
+    def read(self, index):
+        # frames skipped by the schedule are grabbed but not decoded
+        while self.position <= index:
+            self._grab()
+        img = self.capture.retrieve()[1]
+        return cv2.resize(img, self.size, interpolation=cv2.INTER_AREA)
+
+
+class Camera(BaseCamera):
+    video_source = os.environ.get('REPLAY_SOURCE')
+
+    def __init__(self, source=None, fps=REPLAY_FPS, size=REPLAY_SIZE,
+                 stamped=REPLAY_STAMP, **kwargs):
+        if source is None:
+            source = Camera.video_source
+        super().__init__(source, **kwargs)
+        if fps <= 0:
+            raise ValueError('REPLAY_FPS must be positive')
+        self.interval = 1.0 / fps
+        self.size = parse_size(size)
+        self.stamped = stamped
+        self.skipped = 0  # frames the schedule passed over
+
+    def _open_source(self):
+        if not self.source or self.source == 'synthetic':
+            return _SyntheticSource(self.size)
+        if os.path.isdir(self.source):
+            return _DirectorySource(self.source, self.size)
+        return _VideoSource(self.source, self.size)
+
+    def frames(self):
+        source = self._open_source()
+        started = time.time()
+        index = 0
+        while True:
+            due = started + index * self.interval
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # like a real sensor, frames nobody was there to take are gone
+                behind = int(-delay / self.interval)
+                index += behind
+                self.skipped += behind
+                due = started + index * self.interval
+
+            img = source.read(index)
+            if self.stamped:
+                stamp(img, index, due)
+            yield Frame(bgr=img, timestamp=due)
+            index += 1
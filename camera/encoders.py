@@ -0,0 +1,248 @@
+"""JPEG encoding and decoding backends.
+
+Every JPEG the app makes goes through encode() with a JpegSettings: the
+backend, quality, chroma subsampling and optimize/progressive flags. Two
+backends are available:
+
+    opencv     cv2.imencode/imdecode, the default
+    turbojpeg  libjpeg-turbo's TurboJPEG API through PyTurboJPEG
+               (pip install PyTurboJPEG), encodes into reused per thread
+               buffers and is usually the faster of the two
+
+Each consumer of frames has its own settings, read from
+<CONSUMER>_JPEG_ENCODER, _QUALITY, _SUBSAMPLING (444, 422 or 420), _OPTIMIZE
+and _PROGRESSIVE, falling back on JPEG_ENCODER, JPEG_QUALITY etc. for the
+ones that aren't set, e.g. DETECT_JPEG_QUALITY=70 with JPEG_SUBSAMPLING=420.
+OpenCV only takes a subsampling from 4.5.5 on, older versions need the
+turbojpeg backend for it.
+The consumers are STREAM (/video_feed, /stream-detect and /frame),
+DETECT (uploads to the detector), CAPTURE (motion captures) and RECORD
+(clips). Consumers with the same settings share one encode per frame.
+
+With no quality set a sensor's own JPEG (ArduCam, Pi camera) is passed
+through as it is, any other setting only applies to frames that are
+encoded.
+"""
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from . import metrics
+
+try:
+    import cv2
+except ImportError:
+    # picamera only installs (nocv-requirements.txt) only ever pass JPEG on
+    cv2 = None
+
+# OpenCV only takes a chroma subsampling from 4.5.5 on
+OPENCV_SUBSAMPLING = cv2 is not None and \
+    hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR')
+
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+DEFAULT_QUALITY = 95  # OpenCV's
+SUBSAMPLINGS = ('444', '422', '420')
+# the reduced sizes both backends decode to straight from the DCT
+DECODE_SCALES = (8, 4, 2)
+
+ENCODE_SECONDS = metrics.Histogram(
+    'frame_jpeg_encode_seconds', 'Time spent encoding frame views as JPEG',
+    ['encoder'])
+
+
+class JpegSettings(namedtuple('JpegSettings', ('encoder', 'quality',
+                                               'subsampling', 'optimize',
+                                               'progressive'))):
+    """How to encode a JPEG. Hashable, so frames key their cached encodes
+    on it.
+
+    quality None is the backend's default (95) and lets a sensor's JPEG
+    through untouched, subsampling None its default (4:2:0).
+    """
+    __slots__ = ()
+
+    def __new__(cls, encoder='opencv', quality=None, subsampling=None,
+                optimize=False, progressive=False):
+        if encoder not in ENCODERS:
+            raise ValueError('JPEG encoder must be one of %s, got "%s"' %
+                             (', '.join(sorted(ENCODERS)), encoder))
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError('JPEG quality must be between 1 and 100')
+        if subsampling is not None and subsampling not in SUBSAMPLINGS:
+            raise ValueError('JPEG subsampling must be one of %s, got "%s"' %
+                             (', '.join(SUBSAMPLINGS), subsampling))
+        return super().__new__(cls, encoder, quality, subsampling,
+                               bool(optimize), bool(progressive))
+
+    def with_quality(self, quality):
+        """These settings with quality instead, unless quality is None."""
+        return self if quality is None else self._replace(quality=int(quality))
+
+    @classmethod
+    def from_env(cls, consumer=None):
+        """The settings configured for consumer (e.g. 'DETECT'), or the
+        defaults every consumer falls back on."""
+        def get(name):
+            value = os.environ.get('%s_JPEG_%s' % (consumer, name)) \
+                if consumer else None
+            return value if value is not None else \
+                os.environ.get('JPEG_' + name)
+
+        prefix = consumer + '_' if consumer else ''
+        quality = get('QUALITY')
+        encoder = get('ENCODER') or 'opencv'
+        subsampling = get('SUBSAMPLING') or None
+        # rather than on the first frame encoded
+        if encoder == 'turbojpeg' and turbojpeg is None:
+            raise ImportError('%sJPEG_ENCODER=turbojpeg needs PyTurboJPEG and '
+                              'libjpeg-turbo, pip install PyTurboJPEG' % prefix)
+        if encoder == 'opencv' and subsampling and cv2 is not None and \
+                not OPENCV_SUBSAMPLING:
+            raise ValueError('%sJPEG_SUBSAMPLING needs OpenCV 4.5.5 or newer '
+                             '(this is %s), or JPEG_ENCODER=turbojpeg' %
+                             (prefix, cv2.__version__))
+        return cls(encoder=encoder,
+                   quality=int(quality) if quality else None,
+                   subsampling=subsampling,
+                   optimize=get('OPTIMIZE') == 'True',
+                   progressive=get('PROGRESSIVE') == 'True')
+
+
+class OpenCVCodec(object):
+    name = 'opencv'
+
+    def __init__(self):
+        if cv2 is None:
+            raise ImportError('The opencv JPEG encoder needs OpenCV')
+
+    def encode(self, img, settings):
+        params = [cv2.IMWRITE_JPEG_QUALITY, settings.quality or DEFAULT_QUALITY]
+        if settings.subsampling is not None:
+            if not OPENCV_SUBSAMPLING:
+                raise ValueError('JPEG subsampling needs OpenCV 4.5.5 or '
+                                 'newer, this is %s' % cv2.__version__)
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, getattr(
+                cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR_' + settings.subsampling)]
+        if settings.optimize:
+            params += [cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+        if settings.progressive:
+            params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        ok, buf = cv2.imencode('.jpg', img, params)
+        if not ok:
+            raise ValueError('OpenCV failed to encode a %s image' % (img.shape,))
+        return buf.tobytes()
+
+    def decode(self, jpeg, scale=1):
+        flags = cv2.IMREAD_COLOR if scale == 1 else \
+            getattr(cv2, 'IMREAD_REDUCED_COLOR_%i' % scale)
+        return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), flags)
+
+
+class TurboJpegCodec(object):
+    """libjpeg-turbo through PyTurboJPEG.
+
+    Encodes into a buffer kept per thread, grown as needed, rather than one
+    allocated and freed by the library for every frame. libjpeg-turbo's
+    TurboJPEG API has no separate Huffman optimization flag, its
+    progressive JPEGs always have optimized tables, so optimize on its own
+    is ignored.
+    """
+    name = 'turbojpeg'
+
+    def __init__(self):
+        if turbojpeg is None:
+            raise ImportError('The turbojpeg JPEG encoder needs PyTurboJPEG '
+                              'and libjpeg-turbo, pip install PyTurboJPEG')
+        self.turbo = turbojpeg.TurboJPEG()
+        self.subsamplings = {'444': turbojpeg.TJSAMP_444,
+                             '422': turbojpeg.TJSAMP_422,
+                             '420': turbojpeg.TJSAMP_420}
+        self.buffers = threading.local()
+
+    def encode(self, img, settings):
+        subsampling = self.subsamplings[settings.subsampling or '420']
+        flags = turbojpeg.TJFLAG_PROGRESSIVE if settings.progressive else 0
+        pixel_format = turbojpeg.TJPF_BGR if img.ndim == 3 else \
+            turbojpeg.TJPF_GRAY
+        if img.ndim == 2:
+            subsampling = turbojpeg.TJSAMP_GRAY
+        size = self.turbo.buffer_size(img, subsampling)
+        buf = getattr(self.buffers, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = self.buffers.buf = bytearray(size)
+        _, length = self.turbo.encode(
+            img, quality=settings.quality or DEFAULT_QUALITY,
+            pixel_format=pixel_format, jpeg_subsample=subsampling,
+            flags=flags, dst=buf)
+        return bytes(memoryview(buf)[:length])
+
+    def decode(self, jpeg, scale=1):
+        return self.turbo.decode(jpeg, pixel_format=turbojpeg.TJPF_BGR,
+                                 scaling_factor=(1, scale))
+
+
+ENCODERS = {'opencv': OpenCVCodec, 'turbojpeg': TurboJpegCodec}
+
+_codecs = {}
+_lock = threading.Lock()
+
+
+def get_codec(name):
+    """The backend called name, created on first use."""
+    codec = _codecs.get(name)
+    if codec is None:
+        with _lock:
+            codec = _codecs.get(name)
+            if codec is None:
+                codec = _codecs[name] = ENCODERS[name]()
+    return codec
+
+
+def encode(img, settings=None):
+    """img, a BGR or grayscale array, encoded as JPEG bytes."""
+    settings = settings or DEFAULTS
+    codec = get_codec(settings.encoder)
+    with ENCODE_SECONDS.labels(settings.encoder).time():
+        return codec.encode(img, settings)
+
+
+def decode(jpeg, scale=1):
+    """JPEG bytes decoded to a BGR array, 1/scale of the full size (scale
+    is one of 1 and DECODE_SCALES), by the default encoder's backend."""
+    return get_codec(DEFAULTS.encoder).decode(jpeg, scale)
+
+
+def read_shape(jpeg):
+    """The shape JPEG bytes decode to, read from their frame header. None
+    if there isn't one."""
+    data = memoryview(jpeg)
+    i = 2  # past the SOI marker
+    while i + 9 < len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i + 1]
+        if marker == 0xff:  # fill byte
+            i += 1
+            continue
+        length = data[i + 2] << 8 | data[i + 3]
+        # SOF0-SOF15, except DHT, JPG and DAC which share the range
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height = data[i + 5] << 8 | data[i + 6]
+            width = data[i + 7] << 8 | data[i + 8]
+            # frames are always decoded to BGR
+            return height, width, 3
+        i += 2 + length
+    return None
+
+
+DEFAULTS = JpegSettings.from_env()
+STREAM = JpegSettings.from_env('STREAM')
+DETECT = JpegSettings.from_env('DETECT')
+CAPTURE = JpegSettings.from_env('CAPTURE')
+RECORD = JpegSettings.from_env('RECORD')
@@ -0,0 +1,177 @@
+import time
+import threading
+
+from . import encoders
+
+try:
+    import cv2
+except ImportError:
+    # picamera only installs (nocv-requirements.txt) only ever ask for JPEG
+    cv2 = None
+
+MJPEG_BOUNDARY = 'frame'
+MJPEG_MIMETYPE = 'multipart/x-mixed-replace; boundary=' + MJPEG_BOUNDARY
+
+
+def mjpeg_part(jpeg):
+    """Wrap JPEG bytes in one part of a multipart/x-mixed-replace stream."""
+    return b''.join((b'--', MJPEG_BOUNDARY.encode(), b'\r\n'
+                     b'Content-Type: image/jpeg\r\n\r\n', jpeg, b'\r\n\r\n'))
+
+
+def parse_size(spec):
+    """(width, height) of a WIDTHxHEIGHT setting such as 640x480."""
+    width, _, height = spec.partition('x')
+    try:
+        return int(width), int(height)
+    except ValueError:
+        raise ValueError('Expected a size like 640x480, got "%s"' % spec)
+
+
+class Frame(object):
+    """A captured frame and every view derived from it.
+
+    Backends build a frame from whatever the sensor produces, raw BGR pixels
+    or an already encoded JPEG, and the camera thread numbers it when it is
+    published. Derived views (JPEG at a given quality, grayscale, blurred
+    grayscale, scaled copies) are computed on first use and cached on the
+    frame, so each one costs at most one computation per frame no matter how
+    many clients ask for it.
+
+    Scaled copies of a JPEG frame are made from the JPEG decoded at a
+    fraction of its size when that is big enough, so scaled streams of a
+    JPEG sensor never pay for a full size decode.
+
+    A JPEG frame can carry a low resolution BGR preview of the same image
+    (e.g. from a second port of the sensor) along with its full shape, scaled
+    copies no larger than the preview are then made from it and the JPEG is
+    never decoded for them.
+
+    Frames are shared between clients: treat the returned arrays as read only
+    and copy them before drawing on them.
+    """
+    __slots__ = ('seq', 'timestamp', '_bgr', '_jpeg', '_preview', '_shape',
+                 '_views', '_locks', '_lock')
+
+    def __init__(self, bgr=None, jpeg=None, timestamp=None, seq=None,
+                 preview=None, shape=None):
+        if bgr is None and jpeg is None:
+            raise ValueError('A frame needs either BGR pixels or a JPEG')
+        self.seq = seq
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self._bgr = bgr
+        self._jpeg = jpeg
+        self._preview = preview
+        self._shape = shape
+        self._views = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def view(self, key, compute):
+        """Return the view stored under key, computing it only once.
+
+        Consumers can cache their own per-frame derivatives here too, as long
+        as their keys don't clash with the built in ones.
+        """
+        try:
+            return self._views[key]
+        except KeyError:
+            pass
+        # one lock per view so a slow encode doesn't hold up a cheap
+        # grayscale conversion requested by another thread
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._views:
+                self._views[key] = compute()
+            return self._views[key]
+
+    def cached(self, key):
+        """The view stored under key if it was already computed, else
+        None."""
+        return self._views.get(key)
+
+    @property
+    def bgr(self):
+        """The frame as a BGR array, decoded from the JPEG if need be."""
+        if self._bgr is not None:
+            return self._bgr
+        return self.view('bgr', lambda: encoders.decode(self._jpeg))
+
+    @property
+    def sensor_jpeg(self):
+        """The JPEG the backend captured, None for frames captured as BGR."""
+        return self._jpeg
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            if self._bgr is not None:
+                return self._bgr.shape
+            # a JPEG's header has it, no need to decode it
+            self._shape = encoders.read_shape(self._jpeg) or self.bgr.shape
+        return self._shape
+
+    def jpeg(self, quality=None, width=None, settings=None):
+        """The frame encoded as JPEG bytes, scaled down to width if given.
+
+        settings is a consumer's encoders.JpegSettings (the defaults if not
+        given) and quality overrides theirs. With no quality the sensor's own
+        JPEG is passed through when there is one.
+        """
+        settings = (settings or encoders.DEFAULTS).with_quality(quality)
+        if width is not None and width >= self.shape[1]:
+            width = None
+        if settings.quality is None and width is None and self._jpeg is not None:
+            return self._jpeg
+        return self.view(('jpeg', settings, width), lambda: encoders.encode(
+            self.bgr if width is None else self.scaled(width), settings))
+
+    def mjpeg_part(self, quality=None, width=None, settings=None):
+        """The JPEG wrapped as a multipart part (boundary, headers and
+        payload), built once per frame and shared by every viewer."""
+        settings = (settings or encoders.DEFAULTS).with_quality(quality)
+        return self.view(('mjpeg_part', settings, width), lambda: mjpeg_part(
+            self.jpeg(width=width, settings=settings)))
+
+    def gray(self):
+        """The frame converted to grayscale."""
+        return self.view('gray', lambda: cv2.cvtColor(
+            self.bgr, cv2.COLOR_BGR2GRAY))
+
+    def blurred(self, ksize=21):
+        """The grayscale frame with a ksize x ksize Gaussian blur applied."""
+        return self.view(('blurred', ksize), lambda: cv2.GaussianBlur(
+            self.gray(), (ksize, ksize), 0))
+
+    def scaled(self, width, height=None):
+        """The frame resized to width, keeping the aspect ratio unless a
+        height is given too."""
+        if height is None:
+            rows, cols = self.shape[:2]
+            height = max(1, int(round(rows * width / float(cols))))
+        preview = self._preview
+        if preview is not None and preview.shape[:2] == (height, width):
+            return preview
+        if preview is not None and preview.shape[1] >= width and \
+                preview.shape[0] >= height:
+            source = preview
+        elif self._bgr is None and 'bgr' not in self._views:
+            source = self._reduced(width, height)
+        else:
+            source = self.bgr
+        return self.view(('scaled', width, height), lambda: cv2.resize(
+            source, (width, height), interpolation=cv2.INTER_AREA))
+
+    def _reduced(self, width, height):
+        """The JPEG decoded at the smallest size it decodes to directly
+        (1/2, 1/4 or 1/8) that is still at least width x height."""
+        rows, cols = self.shape[:2]
+        for scale in encoders.DECODE_SCALES:
+            if cols // scale >= width and rows // scale >= height:
+                return self.view(('bgr', scale), lambda: encoders.decode(
+                    self._jpeg, scale))
+        return self.bgr
+
+    def __repr__(self):
+        return '<Frame seq=%s timestamp=%.3f>' % (self.seq, self.timestamp)
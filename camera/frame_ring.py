@@ -0,0 +1,235 @@
+"""Frames handed between processes through shared memory.
+
+A FrameRing is a fixed number of equally sized slots in one shared memory
+block. The capture process writes each frame into a free slot and numbers
+it. A reading process maps the same block, and the BGR frames it reads are
+numpy arrays over the shared memory itself: nothing is pickled or copied
+however large the frame is. A JPEG frame is copied out, it is small and
+consumers keep its bytes around (e.g. the recorder's pre-roll).
+
+A slot is pinned for as long as any array over it is alive in the reader.
+The writer skips pinned slots and only overwrites the oldest unpinned one,
+so a frame never changes under a consumer that is still using it. Pinning
+stops short of starving the writer: once pinning another slot would leave
+fewer than FREE_SLOTS unpinned, the reader copies the frame out of its
+slot instead, so however many frames consumers hold on to the writer
+always has a slot to write to. The counts live in shared memory, written
+by the reader and read by the writer, which makes this a ring for one
+writing and one reading process.
+
+The layout, all in native int64/float64:
+
+    header   [slots, slot_bytes, seq, copied] padded to 64 bytes
+    meta     per slot [seq, kind, nbytes, height, width, channels, pins, 0]
+    stamps   per slot capture timestamp
+    data     per slot slot_bytes of frame data
+"""
+import weakref
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .frame import Frame
+
+HEADER_FIELDS = 8
+META_FIELDS = 8
+# header fields
+SLOTS, SLOT_BYTES, SEQ, COPIED = range(4)
+# meta fields
+SLOT_SEQ, KIND, NBYTES, HEIGHT, WIDTH, CHANNELS, PINS = range(7)
+
+BGR, JPEG = 1, 2
+WRITING = -1  # slot seq while its data is being replaced
+# unpinned slots a read leaves the writer, one for the frame being written
+# and one for the read after it
+FREE_SLOTS = 2
+
+
+def _align(size, to=64):
+    return (size + to - 1) // to * to
+
+
+def slot_bytes_for(frame):
+    """The slot size needed for frame and others of the same resolution.
+
+    A JPEG gets as much room as the raw BGR pixels, more than it takes at
+    any quality short of 100.
+    """
+    if frame.sensor_jpeg is not None:
+        height, width = frame.shape[:2]
+        return max(height * width * 3, len(frame.sensor_jpeg))
+    return frame.bgr.nbytes
+
+
+class FrameRing(object):
+    """Shared memory slots holding a camera's newest frames.
+
+    Use create() in the writing process and attach(name) in the reading
+    one.
+    """
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        self.name = shm.name
+        self.header = np.ndarray((HEADER_FIELDS,), np.int64, shm.buf)
+        self.slots = int(self.header[SLOTS])
+        self.slot_bytes = int(self.header[SLOT_BYTES])
+        offset = HEADER_FIELDS * 8
+        self.meta = np.ndarray((self.slots, META_FIELDS), np.int64, shm.buf,
+                               offset)
+        offset += self.slots * META_FIELDS * 8
+        self.stamps = np.ndarray((self.slots,), np.float64, shm.buf, offset)
+        self.data_offset = _align(offset + self.slots * 8)
+        self.pin_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, slots, slot_bytes):
+        if slots <= FREE_SLOTS:
+            raise ValueError('A frame ring needs more than %i slots' % FREE_SLOTS)
+        slot_bytes = _align(slot_bytes)
+        size = _align((HEADER_FIELDS + slots * (META_FIELDS + 1)) * 8) + \
+            slots * slot_bytes
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        header = np.ndarray((HEADER_FIELDS,), np.int64, shm.buf)
+        header[:] = 0
+        header[SLOTS], header[SLOT_BYTES] = slots, slot_bytes
+        del header
+        ring = cls(shm, owner=True)
+        ring.meta[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def seq(self):
+        """The seq of the newest frame written, 0 before the first."""
+        header = self.header
+        return int(header[SEQ]) if header is not None else 0
+
+    @property
+    def copied(self):
+        """BGR frames read as copies because too many slots were pinned."""
+        header = self.header
+        return int(header[COPIED]) if header is not None else 0
+
+    def _data(self, slot):
+        return self.data_offset + slot * self.slot_bytes
+
+    def write(self, frame):
+        """Copy frame into the oldest unpinned slot.
+
+        Returns the frame's seq in the ring. Raises ValueError for frames
+        bigger than a slot.
+        """
+        if frame.sensor_jpeg is not None:
+            kind, shape = JPEG, frame.shape
+            payload = np.frombuffer(frame.sensor_jpeg, np.uint8)
+        else:
+            kind, payload = BGR, np.ascontiguousarray(frame.bgr, np.uint8)
+            shape = payload.shape
+        if payload.nbytes > self.slot_bytes:
+            raise ValueError('A %i byte frame does not fit the %i byte slots '
+                             'of frame ring %s' % (payload.nbytes,
+                                                   self.slot_bytes, self.name))
+        height, width = shape[:2]
+        channels = shape[2] if len(shape) > 2 else 1
+
+        slot = self._claim()
+        meta = self.meta
+        offset = self._data(slot)
+        self.shm.buf[offset:offset + payload.nbytes] = payload.reshape(-1).data
+        meta[slot, KIND:PINS] = (kind, payload.nbytes, height, width, channels)
+        self.stamps[slot] = frame.timestamp
+        seq = self.seq + 1
+        meta[slot, SLOT_SEQ] = seq
+        self.header[SEQ] = seq
+        return seq
+
+    def _claim(self):
+        """Mark the oldest unpinned slot as being written and return it."""
+        meta = self.meta
+        # the reader always leaves FREE_SLOTS unpinned, a pass only comes up
+        # empty if its pins moved from slot to slot while it was scanning
+        for _ in range(3):
+            for slot in np.argsort(meta[:, SLOT_SEQ], kind='stable'):
+                if meta[slot, PINS]:
+                    continue
+                previous = meta[slot, SLOT_SEQ]
+                meta[slot, SLOT_SEQ] = WRITING
+                # the reader pins before it checks the seq, so a pin that came
+                # in since the check above means it may have seen the old seq
+                if meta[slot, PINS]:
+                    meta[slot, SLOT_SEQ] = previous
+                    continue
+                return slot
+        raise RuntimeError('Every slot of frame ring %s is pinned' % self.name)
+
+    def read(self, seq=None):
+        """The Frame written as seq, the newest one by default.
+
+        Returns None if it is no longer in the ring.
+        """
+        seq = self.seq if seq is None else seq
+        slots = np.flatnonzero(self.meta[:, SLOT_SEQ] == seq)
+        if not seq or not len(slots):
+            return None
+        slot = int(slots[0])
+        # pinned while it's read, and for as long as the frame lives if that
+        # still leaves the writer enough slots
+        with self.pin_lock:
+            keep = self.meta[slot, PINS] > 0 or \
+                np.count_nonzero(self.meta[:, PINS] == 0) > FREE_SLOTS
+            self.meta[slot, PINS] += 1
+        pinned = True
+        try:
+            if self.meta[slot, SLOT_SEQ] != seq:
+                return None
+            kind, nbytes, height, width, channels = \
+                (int(value) for value in self.meta[slot, KIND:PINS])
+            timestamp = float(self.stamps[slot])
+            offset = self._data(slot)
+            if kind == JPEG:
+                jpeg = bytes(self.shm.buf[offset:offset + nbytes])
+                return Frame(jpeg=jpeg, timestamp=timestamp,
+                             shape=(height, width, channels))
+            shape = (height, width, channels) if channels > 1 else \
+                (height, width)
+            bgr = np.ndarray(shape, np.uint8, self.shm.buf, offset)
+            if not keep:
+                with self.pin_lock:
+                    self.header[COPIED] += 1
+                return Frame(bgr=bgr.copy(), timestamp=timestamp)
+            bgr.flags.writeable = False
+            # the slot stays pinned until the array (and every view of it)
+            # is gone
+            weakref.finalize(bgr, self._unpin, slot)
+            pinned = False
+            return Frame(bgr=bgr, timestamp=timestamp)
+        finally:
+            if pinned:
+                self._unpin(slot)
+
+    def _unpin(self, slot):
+        with self.pin_lock:
+            if self.meta is not None:
+                self.meta[slot, PINS] -= 1
+
+    def close(self):
+        """Unmap the ring, and remove it if this process created it.
+
+        Returns False while frames read from it are still alive, close()
+        again once they are gone.
+        """
+        with self.pin_lock:
+            self.header = self.meta = self.stamps = None
+        try:
+            self.shm.close()
+        except BufferError:
+            return False
+        if self.owner:
+            self.shm.unlink()
+        return True
@@ -0,0 +1,189 @@
+"""Dependency free metrics, exposed in the Prometheus text format.
+
+Metrics are module level objects created next to the code they measure:
+
+    FRAMES = metrics.Counter('camera_frames_total', 'Frames captured',
+                             ['camera'])
+    frames = FRAMES.labels('front')  # look the child up once
+    frames.inc()                     # then just a lock and an add
+
+Hot paths should keep the labelled child around instead of calling labels()
+every time. Values that already exist elsewhere (a camera's fps, a queue's
+drop count) are read at scrape time with set_function() and cost nothing in
+between. render() returns every registered metric for a /metrics endpoint.
+"""
+import time
+import bisect
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+                   10)
+
+REGISTRY = []
+_lock = threading.Lock()
+
+
+class _Value(object):
+    __slots__ = ('value', 'function', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() when scraped."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self):
+        yield '', (), self.get()
+
+
+class _HistogramValue(object):
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the time spent in its block."""
+        return _Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for upper_bound, count in zip(self.upper_bounds + (float('inf'),), counts):
+            cumulative += count
+            yield '_bucket', (('le', _format(upper_bound)),), cumulative
+        yield '_sum', (), total
+        yield '_count', (), cumulative
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.started)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        with _lock:
+            if any(metric.name == name for metric in REGISTRY):
+                raise ValueError('Metric %s is registered twice' % name)
+            REGISTRY.append(self)
+
+    def _child(self):
+        return _Value()
+
+    def labels(self, *values):
+        """The child metric for these label values."""
+        if len(values) != len(self.labelnames):
+            raise ValueError('%s expects labels %s' % (self.name, self.labelnames))
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            with _lock:
+                child = self.children.setdefault(key, self._child())
+        return child
+
+    def __getattr__(self, attr):
+        # an unlabelled metric is used as its only child, e.g. COUNTER.inc()
+        if attr in ('inc', 'dec', 'set', 'set_function', 'observe', 'time'):
+            return getattr(self.labels(), attr)
+        raise AttributeError(attr)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, _escape(self.documentation, False)),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in sorted(list(self.children.items())):
+            labels = tuple(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                pairs = labels + extra
+                label_text = '{%s}' % ','.join(
+                    '%s="%s"' % (k, _escape(v)) for k, v in pairs) if pairs else ''
+                lines.append('%s%s%s %s' % (self.name, suffix, label_text,
+                                            _format(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(float(bucket) for bucket in sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+
+def _escape(value, quotes=True):
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _format(value):
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if value != value:
+        return 'NaN'
+    return repr(value)
+
+
+def render():
+    """Every registered metric in the Prometheus text format."""
+    with _lock:
+        metrics = list(REGISTRY)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
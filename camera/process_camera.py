@@ -0,0 +1,193 @@
+"""Cameras captured in a process of their own.
+
+Capture, JPEG decoding, motion tracking, RTSP feeding and serving all
+contend for one interpreter's GIL when they run as threads. With
+CAMERA_PROCESS=True the registry hands out ProcessCameras instead: the
+backend (any of the camera_* modules) runs in a child process, writing
+every frame into a FrameRing, and the ProcessCamera in the app's process
+publishes the frames read back from it like any other camera. BGR frames
+are numpy arrays over the shared memory, so the tracker, the streams and
+the detection worker use them without pickling or copying, and capture
+runs on a core of its own.
+
+Demand pacing works as in one process: the rate the app's consumers ask
+for is passed down to the backend's own capture loop, and a one off read
+wakes it up straight away. Only the small control messages (a frame's seq,
+the ring's name) go through a pipe.
+
+CAMERA_RING_SLOTS is how many frames the ring holds. A frame a consumer
+still holds keeps its slot, and once all but two slots are kept frames are
+read as copies instead, so give it a few more slots than there are
+consumers holding on to frames at once.
+"""
+import os
+import time
+import atexit
+import signal
+import logging
+import multiprocessing
+
+from . import metrics
+from .base_camera import BaseCamera, FRAME_TIMEOUT
+from .frame_ring import FrameRing, slot_bytes_for
+
+logger = logging.getLogger()
+
+CAMERA_RING_SLOTS = int(os.environ.get('CAMERA_RING_SLOTS', 8))
+# how often the capture process checks whether it should stop
+CONTROL_SECONDS = .5
+
+RING_COPIED = metrics.Gauge(
+    'camera_ring_copied_frames',
+    'Frames copied out of the ring because too many of its slots were in use',
+    ['camera'])
+
+# spawned, not forked: the app's process is full of threads and locks
+_context = multiprocessing.get_context('spawn')
+
+
+class ProcessCamera(BaseCamera):
+    """A backend's camera run in a child process, read through shared
+    memory."""
+    self_paced = True
+
+    def __init__(self, backend, source=None, name='default',
+                 slots=CAMERA_RING_SLOTS):
+        super().__init__(source, name=name)
+        self.backend = backend
+        self.slots = slots
+        # shared with the capture process, which is paced by target and
+        # woken by capture_wakeup like a camera thread in this process would
+        # be. Only the capture process clears it, this side only sets it
+        self.target = _context.RawValue('d', self.target_fps())
+        self.capture_wakeup = _context.Event()
+        self.ring = None
+        self.retired = []  # closed rings with frames still in use
+        self.stopping = None  # set to stop the running capture process
+        RING_COPIED.labels(name).set_function(self._copied)
+        atexit.register(self.stop_capture)
+
+    def stop_capture(self):
+        """Ask the capture process to stop, the camera thread then ends."""
+        stopping = self.stopping
+        if stopping is not None:
+            stopping.set()
+
+    def _copied(self):
+        ring = self.ring
+        return ring.copied if ring is not None else 0
+
+    def wake(self):
+        self.capture_wakeup.set()
+
+    def request_fps(self, fps):
+        super().request_fps(fps)
+        self.target.value = self.target_fps()
+
+    def frames(self):
+        messages, sender = _context.Pipe(duplex=False)
+        stop = self.stopping = _context.Event()
+        process = _context.Process(
+            target=_capture, name='capture-%s' % self.name,
+            args=(self.backend, self.source, self.name, self.slots, sender,
+                  self.target, self.capture_wakeup, stop))
+        process.daemon = True
+        process.start()
+        sender.close()
+        logger.info('Started capture process %i for %s', process.pid,
+                    self.name)
+        try:
+            while True:
+                seq = None
+                if not messages.poll(FRAME_TIMEOUT):
+                    raise IOError('No frame from the capture process of %s '
+                                  'in %i seconds' % (self.name, FRAME_TIMEOUT))
+                # the newest frame only, like a camera thread that was busy
+                while seq is None or messages.poll():
+                    try:
+                        message = messages.recv()
+                    except EOFError:
+                        if stop.is_set():
+                            return
+                        raise IOError('The capture process of %s exited with '
+                                      'code %s' % (self.name, process.exitcode))
+                    if isinstance(message, str):
+                        self._attach(message)
+                    else:
+                        seq = message
+                self.target.value = self.target_fps()
+                frame = self.ring.read(seq)
+                if frame is not None:
+                    yield frame
+        finally:
+            stop.set()
+            process.join(FRAME_TIMEOUT)
+            if process.is_alive():
+                logger.warning('Terminating capture process %i for %s',
+                               process.pid, self.name)
+                process.terminate()
+                process.join()
+            messages.close()
+            self._attach(None)
+
+    def _attach(self, name):
+        if self.ring is not None:
+            self.retired.append(self.ring)
+            self.ring = None
+        # rings stay mapped until the last frame read from them is gone
+        self.retired = [ring for ring in self.retired if not ring.close()]
+        if name is not None:
+            self.ring = FrameRing.attach(name)
+
+
+def _capture(backend, source, name, slots, sender, target, wakeup, stop):
+    """The capture process: runs the backend's camera, writing its frames
+    into a ring, until stop is set."""
+    from .registry import camera_class
+
+    # multiprocessing terminates daemon processes when the app exits, unwind
+    # so the backend is shut down and the ring removed
+    signal.signal(signal.SIGTERM, _terminated)
+    camera = camera_class(backend)(source, name=name)
+    # paced at whatever the app's process currently asks for
+    camera.target_fps = lambda: target.value
+    state = {'ring': None}
+
+    def write(frame):
+        ring = state['ring']
+        try:
+            if ring is None:
+                ring = state['ring'] = FrameRing.create(slots,
+                                                        slot_bytes_for(frame))
+                sender.send(ring.name)
+            sender.send(ring.write(frame))
+        except ValueError as e:
+            logger.warning(str(e))
+        except (BrokenPipeError, EOFError):
+            # the app's process is gone
+            stop.set()
+
+    camera.add_listener(write)
+    try:
+        while not stop.is_set() and camera.thread is not None:
+            if wakeup.wait(CONTROL_SECONDS):
+                wakeup.clear()
+                camera.wakeup.set()
+            camera.last_access = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        camera.remove_listener(write)
+        # the camera thread shuts the backend down once it sees no access
+        camera.last_access = 0
+        camera.wakeup.set()
+        thread = camera.thread
+        if thread is not None:
+            thread.join(FRAME_TIMEOUT)
+        if state['ring'] is not None:
+            state['ring'].close()
+        sender.close()
+
+
+def _terminated(signum, frame):
+    raise SystemExit(0)
@@ -0,0 +1,89 @@
+"""Camera instances keyed by camera id.
+
+Cameras are configured with the CAMERAS environment variable, a comma
+separated list of id=backend:source entries, e.g.
+
+    CAMERAS=front=opencv:0,side=opencv:/dev/video2,porch=arducam:/dev/ttyACM0
+
+The source is optional (front=opencv uses the backend's own default). When
+CAMERAS isn't set a single camera called "default" is driven by the CAMERA
+backend, as before. The first camera listed is the default one, served on
+the routes that don't name a camera.
+
+With CAMERA_PROCESS=True every camera's backend runs in a process of its
+own and hands frames over through shared memory, see camera.process_camera.
+That needs Python 3.8, the default in-process capture doesn't.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+from importlib import import_module
+
+logger = logging.getLogger()
+
+
+def parse_cameras(spec):
+    """Parse a CAMERAS spec into an ordered {cam_id: (backend, source)}."""
+    cameras = OrderedDict()
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        cam_id, _, backend = entry.partition('=')
+        backend, _, source = backend.partition(':')
+        cam_id, backend, source = cam_id.strip(), backend.strip(), source.strip()
+        if not cam_id or not backend:
+            raise ValueError('Invalid CAMERAS entry "%s", expected '
+                             'id=backend[:source]' % entry)
+        if cam_id in cameras:
+            raise ValueError('Camera id "%s" is configured twice' % cam_id)
+        cameras[cam_id] = (backend, source or None)
+    return cameras
+
+
+CAMERA_SOURCES = parse_cameras(
+    os.environ.get('CAMERAS') or
+    'default=' + (os.environ.get('CAMERA') or 'opencv'))
+DEFAULT_CAMERA_ID = next(iter(CAMERA_SOURCES))
+# capture each camera in a process of its own (see camera.process_camera)
+CAMERA_PROCESS = os.environ.get('CAMERA_PROCESS') == 'True'
+
+_cameras = {}
+_lock = threading.Lock()
+
+
+def camera_ids():
+    return list(CAMERA_SOURCES)
+
+
+def get_camera(cam_id=None):
+    """Return the camera instance for cam_id, creating it on first use.
+
+    Raises KeyError for camera ids that aren't configured.
+    """
+    cam_id = cam_id or DEFAULT_CAMERA_ID
+    with _lock:
+        camera = _cameras.get(cam_id)
+        if camera is None:
+            backend, source = CAMERA_SOURCES[cam_id]
+            logger.info('Creating %s camera "%s" (source %s)',
+                        backend, cam_id, source)
+            if CAMERA_PROCESS:
+                # shared memory needs Python 3.8, only this mode imports it
+                try:
+                    from .process_camera import ProcessCamera
+                except ImportError as e:
+                    raise ImportError('CAMERA_PROCESS=True needs Python 3.8 or '
+                                      'newer (multiprocessing.shared_memory): '
+                                      '%s' % e)
+                camera = ProcessCamera(backend, source, name=cam_id)
+            else:
+                camera = camera_class(backend)(source, name=cam_id)
+            _cameras[cam_id] = camera
+        return camera
+
+
+def camera_class(backend):
+    """The Camera class of a backend, e.g. opencv."""
+    return import_module('camera.camera_' + backend).Camera
@@ -3,10 +3,11 @@ Credits: https://stackoverflow.com/questions/47396372/write-opencv-frames-into-g
 Also, it's adapted from: https://github.com/tamaggo/gstreamer-examples
 
 """
+import os
 import logging
-import base64
+import threading
+import functools
 
-import cv2
 import gi
 
 logger = logging.getLogger()
@@ -15,57 +16,239 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from . import metrics
+from .base_camera import CAMERA_MAX_FPS
+from .frame import parse_size
+
 CHANNEL = '/live'
+RTSP_FPS = int(os.environ.get('RTSP_FPS', 10))
 RTSP_URL = 'rtsp://localhost:8554' + CHANNEL
 
+RTSP_PUSHES = metrics.Counter(
+    'rtsp_push_buffer_total', 'appsrc push-buffer calls by flow return',
+    ['mount', 'result'])
+RTSP_DROPPED = metrics.Counter(
+    'rtsp_frames_dropped_total', 'Frames dropped because the encoder was behind',
+    ['mount'])
+
+
+class StreamVariant(object):
+    """One RTSP rendition of a camera, served on CHANNEL/<camera><suffix>.
+
+    width/height of None keep the capture size, bitrate is in kbit/s (None
+    leaves it to x264) and annotated variants have the latest detection
+    boxes drawn on them.
+    """
+
+    def __init__(self, suffix, width=None, height=None, fps=RTSP_FPS,
+                 preset='ultrafast', bitrate=None, annotated=False):
+        self.suffix = suffix
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.preset = preset
+        self.bitrate = bitrate
+        self.annotated = annotated
+
+    def image(self, frame, annotate=None):
+        """The BGR pixels this variant streams for frame."""
+        if self.annotated and annotate is not None:
+            return annotate(frame)
+        if self.width:
+            return frame.scaled(self.width, self.height)
+        return frame.bgr
+
+    def encoder(self):
+        options = 'speed-preset={} tune=zerolatency'.format(self.preset)
+        if self.bitrate:
+            options += ' bitrate={}'.format(self.bitrate)
+        return 'x264enc ' + options
+
+
+# main stream for NVRs, low res substream for phones and the detection
+# annotated stream for dashboards
+RTSP_VARIANTS = [
+    StreamVariant('', fps=RTSP_FPS,
+                  preset=os.environ.get('RTSP_MAIN_PRESET', 'ultrafast')),
+    StreamVariant('/sub', *parse_size(os.environ.get('RTSP_SUB_SIZE', '320x240')),
+                  fps=int(os.environ.get('RTSP_SUB_FPS', 5)),
+                  preset=os.environ.get('RTSP_SUB_PRESET', 'ultrafast'),
+                  bitrate=int(os.environ.get('RTSP_SUB_BITRATE', 256))),
+    StreamVariant('/detect', fps=int(os.environ.get('RTSP_DETECT_FPS', RTSP_FPS)),
+                  preset=os.environ.get('RTSP_DETECT_PRESET', 'ultrafast'),
+                  annotated=True),
+]
+
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
-    def __init__(self, camera_source, **properties):
+    """Feeds a camera into RTSP clients.
+
+    Frames are pushed from the camera thread (BaseCamera.add_listener) as
+    they are captured instead of being pulled on need-data, so the GStreamer
+    streaming thread never blocks waiting on the camera. Buffers are
+    timestamped from the real capture time. The caps follow the actual
+    frame size, the framerate they announce is fixed per factory so a
+    capture rate that wobbles never makes appsrc renegotiate.
+
+    Factories are shared, so each variant is encoded once however many
+    clients watch it.
+    """
+
+    def __init__(self, camera, variant=RTSP_VARIANTS[0], annotate=None,
+                 **properties):
         super(SensorFactory, self).__init__(**properties)
-        self.Camera = camera_source
-        self.cap = camera_source()
-        self.number_frames = 0
-        self.fps = 10
-        self.duration = 1 / self.fps * Gst.SECOND  # duration of a frame in nanoseconds
-        self.launch_string = 'appsrc name=source is-live=true block=true format=GST_FORMAT_TIME ' \
-                             'caps=video/x-raw,format=BGR,width=640,height=480,framerate={}/1 ' \
-                             '! videoconvert ! video/x-raw,format=I420 ' \
-                             '! x264enc speed-preset=ultrafast tune=zerolatency ' \
-                             '! rtph264pay config-interval=1 name=pay0 pt=96'.format(
-                                 self.fps)
+        self.cap = camera
+        self.variant = variant
+        self.annotate = annotate
+        self.fps = variant.fps
+        # never announce more than the camera is allowed to deliver
+        self.rate = int(round(min(self.fps, CAMERA_MAX_FPS or self.fps))) or 1
+        self.lock = threading.Lock()
+        self.sources = []  # _AppSource for every prepared media
 
-    def on_need_data(self, src, length):
-        if self.cap.has_shutdown:
-            self.cap = self.Camera()
-        frame, _ = self.cap.get_frame()
-        data = frame.tostring()
-        buf = Gst.Buffer.new_allocate(None, len(data), None)
-        buf.fill(0, data)
-        buf.duration = self.duration
-        timestamp = self.number_frames * self.duration
-        buf.pts = buf.dts = int(timestamp)
-        buf.offset = timestamp
-        self.number_frames += 1
-        retval = src.emit('push-buffer', buf)
-        if retval != Gst.FlowReturn.OK:
-            logger.warning(
-                "RTSP streamer didn't return OK, returned {0}".format(retval))
+    def caps(self, frame):
+        height, width = self.variant.image(frame, self.annotate).shape[:2]
+        return 'video/x-raw,format=BGR,width={},height={},framerate={}/1'.format(
+            width, height, self.rate)
+
+    def launch_string(self, caps):
+        return 'appsrc name=source is-live=true block=false format=GST_FORMAT_TIME ' \
+               'caps={} ' \
+               '! videoconvert ! video/x-raw,format=I420 ' \
+               '! {} ' \
+               '! rtph264pay config-interval=1 name=pay0 pt=96'.format(
+                   caps, self.variant.encoder())
+
+    def push(self, frame):
+        """Camera listener, pushes frame to every prepared media that
+        takes it."""
+        if not self.sources:
+            return
+        # keeps the camera running at the rate this mount streams at
+        self.cap.request_fps(self.fps)
+        # the camera may run faster than this mount for other consumers, a
+        # frame no media takes isn't annotated, scaled or copied
+        sources = [source for source in self.sources if source.wants(frame)]
+        if not sources:
+            return
+        buf = frame_buffer(frame, self.variant, self.annotate)
+        for source in sources:
+            source.push(frame, buf)
 
     def do_create_element(self, url):
-        return Gst.parse_launch(self.launch_string)
+        # the first frame tells the real frame size to negotiate
+        return Gst.parse_launch(self.launch_string(
+            self.caps(self.cap.get_frame())))
 
     def do_configure(self, rtsp_media):
-        print('do_configure', rtsp_media)
-        self.number_frames = 0
         appsrc = rtsp_media.get_element().get_child_by_name('source')
+        source = _AppSource(self, appsrc)
+        rtsp_media.connect('unprepared', lambda media: self._remove(source))
+        with self.lock:
+            self.sources = self.sources + [source]
+            if len(self.sources) == 1:
+                self.cap.add_listener(self.push)
+        self.cap.request_fps(self.fps)
+
+    def _remove(self, source):
+        with self.lock:
+            self.sources = [s for s in self.sources if s is not source]
+            if not self.sources:
+                self.cap.remove_listener(self.push)
+
+
+class _AppSource(object):
+    """The appsrc of one prepared media and its timestamping state."""
+
+    def __init__(self, factory, appsrc):
+        self.factory = factory
+        self.appsrc = appsrc
+        self.caps = None
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.wants_data = True
+        self.mount = factory.cap.name + factory.variant.suffix
+        self.dropped = RTSP_DROPPED.labels(self.mount)
         appsrc.connect('need-data', self.on_need_data)
+        appsrc.connect('enough-data', self.on_enough_data)
+
+    def on_need_data(self, src, length):
+        self.wants_data = True
+
+    def on_enough_data(self, src):
+        # the encoder is behind, drop frames until it asks again
+        self.wants_data = False
+
+    def wants(self, frame):
+        """Whether frame is due at this media's rate and its encoder is
+        ready for it."""
+        if self.last_timestamp is not None and \
+                frame.timestamp - self.last_timestamp < 0.9 / self.factory.fps:
+            return False
+        if not self.wants_data:
+            self.dropped.inc()
+            return False
+        return True
+
+    def push(self, frame, buf):
+        interval = 1.0 / self.factory.fps
+        caps = self.factory.caps(frame)
+        if caps != self.caps:
+            if self.caps is not None:
+                logger.info('RTSP caps changed to %s', caps)
+            self.appsrc.set_property('caps', Gst.Caps.from_string(caps))
+            self.caps = caps
+
+        if self.first_timestamp is None:
+            self.first_timestamp = frame.timestamp
+        self.last_timestamp = frame.timestamp
+
+        # a shallow copy shares the frame's memory, only the timestamps
+        # are this media's own
+        buf = buf.copy()
+        buf.pts = buf.dts = int((frame.timestamp - self.first_timestamp) * Gst.SECOND)
+        buf.duration = int(interval * Gst.SECOND)
+        retval = self.appsrc.emit('push-buffer', buf)
+        RTSP_PUSHES.labels(self.mount, retval.value_nick).inc()
+        if retval != Gst.FlowReturn.OK:
+            logger.warning(
+                "RTSP streamer didn't return OK, returned {0}".format(retval))
+
+
+def frame_buffer(frame, variant, annotate=None):
+    """The variant's pixels for frame as a Gst.Buffer, made once per frame
+    and shared by every media pushing it.
+
+    PyGObject can't hand GStreamer a pointer into numpy memory without
+    marshalling the bytes, but that now happens once per frame rather than
+    as a tostring() plus fill() copy for every pull of every media.
+    """
+    return frame.view(('gst_buffer', variant.suffix), lambda: Gst.Buffer.new_wrapped(
+        variant.image(frame, annotate).tobytes()))
 
 
 class GstServer(GstRtspServer.RTSPServer):
-    def __init__(self, camera_source, **properties):
+    """Serves every variant of every camera on
+    CHANNEL/<camera name><variant suffix>, the first camera's variants are
+    also served on CHANNEL<variant suffix>.
+
+    annotate(camera, frame) returns frame's pixels with detections drawn on
+    them, without it annotated variants aren't served.
+    """
+
+    def __init__(self, cameras, variants=RTSP_VARIANTS, annotate=None,
+                 **properties):
         super(GstServer, self).__init__(**properties)
-        self.factory = SensorFactory(camera_source)
-        self.factory.set_shared(True)
+        self.factories = {}
+        for camera in cameras:
+            for variant in variants:
+                if variant.annotated and annotate is None:
+                    continue
+                factory = SensorFactory(
+                    camera, variant,
+                    functools.partial(annotate, camera) if annotate else None)
+                factory.set_shared(True)
+                self.factories[camera.name, variant.suffix] = factory
         # Auth is broken for now
         # auth = GstRtspServer.RTSPAuth()
         # token = GstRtspServer.RTSPToken()
@@ -75,14 +258,18 @@ class GstServer(GstRtspServer.RTSPServer):
         # self.set_auth(auth)
         # print('basic', basic)
         self.attach(None)
-        self.get_mount_points().add_factory(CHANNEL, self.factory)
+        mounts = self.get_mount_points()
+        for (name, suffix), factory in self.factories.items():
+            mounts.add_factory(CHANNEL + '/' + name + suffix, factory)
+            if name == cameras[0].name:
+                mounts.add_factory(CHANNEL + suffix, factory)
 
 
-def start_rtsp(camera_source):
+def start_rtsp(cameras, annotate=None):
     GObject.threads_init()
     Gst.init(None)
 
-    GstServer(camera_source)
+    GstServer(cameras, annotate=annotate)
 
     loop = GObject.MainLoop()
     logger.info('RTSP server started!')
@@ -0,0 +1,295 @@
+"""Background object detection that always works on the newest frame.
+
+The remote detector is far slower than the camera, so rather than sending
+every frame and stalling the stream on each round trip, frames are handed
+to a per camera DetectionWorker. Only the newest submitted frame is kept,
+older ones are dropped, and the stream overlays the latest result it has
+onto live frames.
+
+Most of the day a door camera looks at an unchanged scene, so detections are
+also cached per camera against a cheap fingerprint of the frame they were
+made on, and frames that look the same reuse them instead of calling the
+detector again.
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import utils
+from camera import encoders, metrics
+from camera.frame import mjpeg_part
+
+logger = logging.getLogger()
+
+DETECT_CONCURRENCY = int(os.environ.get('DETECT_CONCURRENCY', 1))
+# a frame reuses cached detections when its difference hash is within
+# DETECT_CACHE_MAX_BITS bits of the cached frame's and no cell of its
+# thumbnail is more than DETECT_CACHE_MAX_DIFF grey levels off
+DETECT_CACHE_MAX_BITS = int(os.environ.get('DETECT_CACHE_MAX_BITS', 3))
+DETECT_CACHE_MAX_DIFF = float(os.environ.get('DETECT_CACHE_MAX_DIFF', 10))
+DETECT_CACHE_TTL = float(os.environ.get('DETECT_CACHE_TTL_SECONDS', 60))
+DETECT_CACHE_SIZE = int(os.environ.get('DETECT_CACHE_SIZE', 16))
+THUMBNAIL_SIZE = (32, 24)
+
+DETECT_DROPPED = metrics.Counter(
+    'detection_frames_dropped_total',
+    'Frames replaced by a newer one before a detector thread was free',
+    ['camera'])
+DETECT_SUBMITTED = metrics.Counter(
+    'detection_frames_submitted_total', 'Frames submitted for detection',
+    ['camera'])
+DETECT_CACHE_LOOKUPS = metrics.Counter(
+    'detection_cache_lookups_total', 'Detection cache lookups', ['camera', 'result'])
+
+
+def fingerprint(frame):
+    """A (difference hash, thumbnail) pair describing the frame's scene.
+
+    The 64 bit hash finds candidate entries cheaply, the 32x24 grayscale
+    thumbnail confirms them cell by cell (a cell is a 20x20 pixel block of a
+    640x480 frame) so a small object entering the scene isn't averaged away
+    by the rest of it. Cached on the frame.
+    """
+    def compute():
+        thumbnail = cv2.resize(frame.gray(), THUMBNAIL_SIZE,
+                               interpolation=cv2.INTER_AREA)
+        small = cv2.resize(thumbnail, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = np.packbits(small[:, 1:] > small[:, :-1])
+        return int.from_bytes(bits.tobytes(), 'big'), thumbnail
+    return frame.view('fingerprint', compute)
+
+
+class DetectionCache(object):
+    """Size bounded, expiring cache of detections keyed on scene
+    fingerprints."""
+
+    def __init__(self, max_bits=DETECT_CACHE_MAX_BITS,
+                 max_diff=DETECT_CACHE_MAX_DIFF, ttl=DETECT_CACHE_TTL,
+                 size=DETECT_CACHE_SIZE):
+        self.max_bits = max_bits
+        self.max_diff = max_diff
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()  # dhash -> (thumbnail, detections, time)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, frame):
+        """Return cached detections for a frame of the same scene, or
+        None."""
+        dhash, thumbnail = fingerprint(frame)
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            for key, (cached_thumbnail, detections, _) in reversed(self.entries.items()):
+                if bin(key ^ dhash).count('1') > self.max_bits:
+                    continue
+                # the most changed cell, a mean over the whole thumbnail
+                # would dilute a local change
+                diff = cv2.absdiff(cached_thumbnail, thumbnail).max()
+                if diff <= self.max_diff:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return detections
+            self.misses += 1
+            return None
+
+    def put(self, frame, detections):
+        dhash, thumbnail = fingerprint(frame)
+        with self.lock:
+            self.entries.pop(dhash, None)
+            self.entries[dhash] = (thumbnail, detections, time.time())
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def _expire(self, now):
+        # entries are in insertion/use order, not time order, so check all
+        for key in [key for key, entry in self.entries.items()
+                    if now - entry[2] > self.ttl]:
+            del self.entries[key]
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0
+            }
+
+
+class DetectionResult(object):
+    """Detections for one frame, with how long they took and how old they
+    are."""
+    __slots__ = ('detections', 'frame_seq', 'captured_at', 'started_at',
+                 'finished_at')
+
+    def __init__(self, detections, frame, started_at, finished_at):
+        self.detections = detections
+        self.frame_seq = frame.seq
+        self.captured_at = frame.timestamp
+        self.started_at = started_at
+        self.finished_at = finished_at
+
+    @property
+    def results(self):
+        return self.detections.get('results') or []
+
+    @property
+    def latency(self):
+        """Seconds the detector took to answer."""
+        return self.finished_at - self.started_at
+
+    def staleness(self, now=None):
+        """Seconds since the detected frame was captured."""
+        return (now or time.time()) - self.captured_at
+
+    def as_dict(self):
+        return dict(self.detections,
+                    frame_seq=self.frame_seq,
+                    latency=self.latency,
+                    staleness=self.staleness())
+
+
+class DetectionWorker(object):
+    """Runs the remote detector on the newest frame submitted to it.
+
+    `concurrency` threads share a single pending slot, so a frame waiting
+    for a free thread is replaced by any newer one rather than queued.
+    """
+
+    def __init__(self, name, concurrency=DETECT_CONCURRENCY, cache=None,
+                 detect=utils.check_detect):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.cache = cache
+        self.detect = detect
+        self.condition = threading.Condition()
+        self.pending = None
+        self.result = None
+        self.submitted = 0
+        self.dropped = 0
+        self.threads = []
+        DETECT_SUBMITTED.labels(name).set_function(lambda: self.submitted)
+        DETECT_DROPPED.labels(name).set_function(lambda: self.dropped)
+
+    def start(self):
+        with self.condition:
+            if self.threads:
+                return
+            for i in range(self.concurrency):
+                thread = threading.Thread(
+                    target=self._run, name='detect-%s-%i' % (self.name, i))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, frame):
+        """Queue frame for detection, replacing any frame still waiting."""
+        with self.condition:
+            if self.pending is not None:
+                if self.pending.seq >= frame.seq:
+                    return
+                self.dropped += 1
+            self.pending = frame
+            self.submitted += 1
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None)
+                frame, self.pending = self.pending, None
+
+            started_at = time.time()
+            try:
+                detections = utils.detect_frame(frame, self.cache,
+                                                self.detect)
+            except Exception as e:
+                logger.exception(e)
+                continue
+            result = DetectionResult(detections, frame, started_at,
+                                     time.time())
+            logger.debug('Detection on %s frame %i took %.3fs',
+                         self.name, result.frame_seq, result.latency)
+
+            with self.condition:
+                # with several threads an older frame can finish last
+                if self.result is None or result.frame_seq > self.result.frame_seq:
+                    self.result = result
+
+
+_caches = {}
+_workers = {}
+_lock = threading.Lock()
+
+
+def get_cache(camera):
+    """Return the DetectionCache for a camera."""
+    with _lock:
+        cache = _caches.get(camera.name)
+        if cache is None:
+            cache = _caches[camera.name] = DetectionCache()
+            DETECT_CACHE_LOOKUPS.labels(camera.name, 'hit').set_function(
+                lambda: cache.hits)
+            DETECT_CACHE_LOOKUPS.labels(camera.name, 'miss').set_function(
+                lambda: cache.misses)
+        return cache
+
+
+def get_worker(camera):
+    """Return the running DetectionWorker for a camera."""
+    cache = get_cache(camera)
+    with _lock:
+        worker = _workers.get(camera.name)
+        if worker is None:
+            worker = _workers[camera.name] = DetectionWorker(camera.name,
+                                                             cache=cache)
+            worker.start()
+        return worker
+
+
+def annotated_image(frame, result):
+    """frame's BGR pixels with result's boxes drawn on them.
+
+    Cached on the frame, so every consumer of the same frame and result
+    shares one drawing.
+    """
+    if result is None or not result.results:
+        return frame.bgr
+
+    def draw():
+        # the frame is shared with every other client
+        image = frame.bgr.copy()
+        for boxes in result.results:
+            image = utils.draw_boxes(image, boxes)
+        return image
+    return frame.view(('detections', result.frame_seq), draw)
+
+
+def annotated_part(frame, result):
+    """frame as a multipart part with result's boxes drawn on it, encoded
+    once per frame and result."""
+    if result is None or not result.results:
+        return frame.mjpeg_part(settings=encoders.STREAM)
+    return frame.view(('detections_part', result.frame_seq), lambda: mjpeg_part(
+        encoders.encode(annotated_image(frame, result), encoders.STREAM)))
+
+
+def annotate(camera, frame):
+    """Queue frame for detection and return it annotated with the camera's
+    latest detections, for streams drawing boxes on live frames."""
+    worker = get_worker(camera)
+    worker.submit(frame)
+    return annotated_image(frame, worker.result)
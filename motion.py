@@ -0,0 +1,117 @@
+"""Low cost motion detection.
+
+Frames are downscaled to MOTION_WIDTH and compared against an exponentially
+weighted running average of the scene, so slow lighting changes are absorbed
+while anything moving stands out. Regions of interest restrict where motion
+counts, e.g. to ignore the street:
+
+    MOTION_INCLUDE=0,0.4,1,0.6    only look at the bottom 60% of the frame
+    MOTION_EXCLUDE=0.7,0,0.3,0.5  but ignore the top right corner
+
+Rectangles are x,y,w,h fractions of the frame separated by ";". A camera can
+override them with MOTION_INCLUDE_<ID> / MOTION_EXCLUDE_<ID> (id upper
+cased).
+"""
+import os
+
+import cv2
+import numpy as np
+
+from camera.base_camera import FULL_RATE
+
+MOTION_WIDTH = int(os.environ.get('MOTION_WIDTH', 320))
+MOTION_FPS = float(os.environ.get('MOTION_FPS', 5))
+MOTION_BACKGROUND_ALPHA = float(os.environ.get('MOTION_BACKGROUND_ALPHA', 0.05))
+MOTION_THRESHOLD = int(os.environ.get('MOTION_THRESHOLD', 25))
+# smallest region reported, as a fraction of the frame area
+MOTION_MIN_AREA = float(os.environ.get('MOTION_MIN_AREA', 0.0036))
+
+
+def parse_rois(spec):
+    """Parse "x,y,w,h;x,y,w,h" fractions into a list of tuples."""
+    rois = []
+    for roi in (spec or '').split(';'):
+        if roi.strip():
+            values = tuple(float(v) for v in roi.split(','))
+            if len(values) != 4:
+                raise ValueError('Invalid motion ROI "%s", expected x,y,w,h' % roi)
+            rois.append(values)
+    return rois
+
+
+class MotionDetector(object):
+    """Finds moving regions in a camera's frames.
+
+    detect() returns an (N, 4) array of x, y, w, h boxes in full frame
+    pixels, one per region larger than min_area, largest first.
+    """
+
+    def __init__(self, width=MOTION_WIDTH, fps=MOTION_FPS,
+                 alpha=MOTION_BACKGROUND_ALPHA, threshold=MOTION_THRESHOLD,
+                 min_area=MOTION_MIN_AREA, include=None, exclude=None):
+        self.width = width
+        self.fps = fps if fps > 0 else FULL_RATE
+        self.interval = 1.0 / fps if fps > 0 else 0
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_area = min_area
+        self.include = include or []
+        self.exclude = exclude or []
+        self.background = None
+        self.mask = None
+
+    @classmethod
+    def for_camera(cls, name):
+        suffix = '_' + name.upper()
+        return cls(include=parse_rois(os.environ.get('MOTION_INCLUDE' + suffix,
+                                                     os.environ.get('MOTION_INCLUDE'))),
+                   exclude=parse_rois(os.environ.get('MOTION_EXCLUDE' + suffix,
+                                                     os.environ.get('MOTION_EXCLUDE'))))
+
+    def reset(self):
+        self.background = None
+
+    def _build_mask(self, shape):
+        """The include/exclude regions as a uint8 mask, None if every pixel
+        counts."""
+        if not self.include and not self.exclude:
+            return None
+        rows, cols = shape
+        mask = np.zeros(shape, np.uint8) if self.include else np.full(shape, 255, np.uint8)
+
+        def pixels(roi):
+            x, y, w, h = roi
+            return (slice(int(y * rows), int(round((y + h) * rows))),
+                    slice(int(x * cols), int(round((x + w) * cols))))
+        for roi in self.include:
+            mask[pixels(roi)] = 255
+        for roi in self.exclude:
+            mask[pixels(roi)] = 0
+        return mask
+
+    def detect(self, frame):
+        small = frame.scaled(min(self.width, frame.shape[1]))
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)
+
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray.astype(np.float32)
+            self.mask = self._build_mask(gray.shape)
+            return np.empty((0, 4), np.int32)
+
+        delta = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+
+        thresh = cv2.threshold(delta, self.threshold, 255, cv2.THRESH_BINARY)[1]
+        thresh = cv2.dilate(thresh, None, iterations=2)
+        if self.mask is not None:
+            thresh = cv2.bitwise_and(thresh, self.mask)
+
+        _, _, stats, _ = cv2.connectedComponentsWithStats(thresh)
+        stats = stats[1:]  # label 0 is the background
+        areas = stats[:, cv2.CC_STAT_AREA]
+        stats = stats[areas >= self.min_area * gray.size]
+        stats = stats[np.argsort(-stats[:, cv2.CC_STAT_AREA])]
+
+        scale = frame.shape[1] / float(gray.shape[1])
+        return np.rint(stats[:, :4] * scale).astype(np.int32)
@@ -0,0 +1,126 @@
+"""Event clips with pre and post roll.
+
+Each tracked camera keeps its last RECORD_PRE_SECONDS of frames as JPEG in a
+memory ring buffer (capped at RECORD_BUFFER_BYTES). When motion triggers a
+clip the buffered frames are written first, then frames keep being recorded
+until RECORD_POST_SECONDS after the last trigger. Motion that goes on for
+longer than RECORD_MAX_SECONDS is split into several clips, so no single
+file outgrows the storage quotas. Clips are MJPEG streams
+(concatenated JPEGs, playable by VLC or ffplay) so frames are never
+re-encoded, and all file writes go through the storage.CaptureStorage
+writer thread so a slow SD card never blocks capture or tracking.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+
+from camera import encoders
+from camera.base_camera import FULL_RATE
+
+logger = logging.getLogger()
+
+RECORD_CLIPS = os.environ.get('RECORD_CLIPS', 'True') == 'True'
+RECORD_PRE_SECONDS = float(os.environ.get('RECORD_PRE_SECONDS', 5))
+RECORD_POST_SECONDS = float(os.environ.get('RECORD_POST_SECONDS', 10))
+RECORD_FPS = float(os.environ.get('RECORD_FPS', 5))
+RECORD_BUFFER_BYTES = int(os.environ.get('RECORD_BUFFER_BYTES', 8 * 1024 * 1024))
+RECORD_MAX_SECONDS = float(os.environ.get('RECORD_MAX_SECONDS', 300))
+
+
+class FrameRingBuffer(object):
+    """The most recent (timestamp, JPEG) pairs, bounded by age and by total
+    bytes."""
+
+    def __init__(self, seconds=RECORD_PRE_SECONDS, max_bytes=RECORD_BUFFER_BYTES):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def push(self, timestamp, jpeg):
+        with self.lock:
+            self.frames.append((timestamp, jpeg))
+            self.bytes += len(jpeg)
+            while self.frames and (self.bytes > self.max_bytes or
+                                   self.frames[0][0] < timestamp - self.seconds):
+                self.bytes -= len(self.frames.popleft()[1])
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.frames)
+
+
+class ClipRecorder(object):
+    """Records pre/post roll clips of one camera into directory."""
+
+    def __init__(self, camera, directory, storage, clips=RECORD_CLIPS,
+                 post_seconds=RECORD_POST_SECONDS, fps=RECORD_FPS, ring=None,
+                 max_seconds=RECORD_MAX_SECONDS):
+        self.camera = camera
+        self.directory = directory
+        self.storage = storage
+        self.clips = clips
+        self.post_seconds = post_seconds
+        self.max_seconds = max_seconds
+        self.fps = fps if fps > 0 else FULL_RATE
+        self.interval = 1.0 / fps if fps > 0 else 0
+        self.ring = ring or FrameRingBuffer()
+        self.lock = threading.Lock()
+        self.record_until = 0
+        self.clip = None  # path of the clip being recorded
+        self.clip_started = None  # timestamp its first live frame is from
+
+    def start(self):
+        if self.clips:
+            thread = threading.Thread(
+                target=self._feed, name='record-%s' % self.camera.name)
+            thread.daemon = True
+            thread.start()
+
+    def trigger(self, timestamp=None):
+        """Start a clip, or extend the one being recorded."""
+        if not self.clips:
+            return
+        timestamp = timestamp or time.time()
+        with self.lock:
+            if self.clip is None:
+                self._open_clip(timestamp)
+                for _, jpeg in self.ring.snapshot():
+                    self.storage.append(self.clip, jpeg)
+            self.record_until = max(self.record_until,
+                                    timestamp + self.post_seconds)
+
+    def _open_clip(self, timestamp):
+        self.clip = os.path.join(self.directory, datetime.fromtimestamp(
+            timestamp).strftime('%Y-%m-%d_%H_%M_%S') + '.mjpeg')
+        self.clip_started = timestamp
+        logger.info('Recording clip %s', self.clip)
+
+    def _feed(self):
+        seq = None
+        while True:
+            started = time.time()
+            frame = self.camera.get_frame(after=seq, fps=self.fps)
+            seq = frame.seq
+            jpeg = frame.jpeg(settings=encoders.RECORD)
+            self.ring.push(frame.timestamp, jpeg)
+            with self.lock:
+                if self.clip is not None:
+                    if frame.timestamp <= self.record_until:
+                        if frame.timestamp - self.clip_started > self.max_seconds:
+                            # carry on in a new clip
+                            logger.info('Finished clip %s', self.clip)
+                            self.storage.close(self.clip)
+                            self._open_clip(frame.timestamp)
+                        self.storage.append(self.clip, jpeg)
+                    else:
+                        logger.info('Finished clip %s', self.clip)
+                        self.storage.close(self.clip)
+                        self.clip = None
+            # not held while waiting for the next one
+            del frame
+            time.sleep(max(0, self.interval - (time.time() - started)))
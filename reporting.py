@@ -0,0 +1,109 @@
+"""Motion gated detection and upstream reporting.
+
+The motion trackers queue utils.MotionEvent objects, this worker groups them
+into per camera motion windows and only sends a few sampled frames of each
+window to the detector, so YOLO is only paid for when something is actually
+at the door.
+
+A window opens on the first motion event and closes once no motion has been
+seen for REPORT_UP_DURATION_SECONDS. Within a window at most
+REPORT_SAMPLES_PER_WINDOW frames, REPORT_SAMPLE_INTERVAL_SECONDS apart, are
+detected; sampling stops early once something was reported. After a window
+closes the camera's motion is ignored for REPORT_COOLDOWN_SECONDS.
+"""
+import os
+import time
+import queue
+import logging
+
+import utils
+from camera import encoders
+
+logger = logging.getLogger()
+
+REPORT_UP_DURATION_SECONDS = float(os.environ.get('REPORT_UP_DURATION_SECONDS', 5))
+REPORT_SAMPLES_PER_WINDOW = int(os.environ.get('REPORT_SAMPLES_PER_WINDOW', 3))
+REPORT_SAMPLE_INTERVAL_SECONDS = float(os.environ.get('REPORT_SAMPLE_INTERVAL_SECONDS', 1))
+REPORT_COOLDOWN_SECONDS = float(os.environ.get('REPORT_COOLDOWN_SECONDS', 30))
+
+
+class MotionWindow(object):
+    __slots__ = ('opened_at', 'last_motion', 'last_sample', 'samples',
+                 'reported')
+
+    def __init__(self, now):
+        self.opened_at = now
+        self.last_motion = now
+        self.last_sample = None
+        self.samples = 0
+        self.reported = False
+
+    def wants_sample(self, now):
+        if self.reported or self.samples >= REPORT_SAMPLES_PER_WINDOW:
+            return False
+        return (self.last_sample is None or
+                now - self.last_sample >= REPORT_SAMPLE_INTERVAL_SECONDS)
+
+
+class ReportWorker(object):
+    """Consumes utils.MOTION_EVENTS and reports sampled detections."""
+
+    def __init__(self, events=utils.MOTION_EVENTS):
+        self.events = events
+        self.windows = {}  # camera name -> open MotionWindow
+        self.cooldowns = {}  # camera name -> time motion is listened to again
+
+    def run(self):
+        logger.info('Starting motion report worker')
+        while utils.REPORTING.is_set():
+            try:
+                event = self.events.get(timeout=REPORT_UP_DURATION_SECONDS)
+            except queue.Empty:
+                event = None
+            self._close_windows(event.timestamp if event else None)
+            if event is not None:
+                # a failed report must not take the worker down with it
+                try:
+                    self.handle(event)
+                except Exception as e:
+                    logger.exception(e)
+        logger.info('Motion report worker stopped')
+
+    def handle(self, event):
+        name = event.camera.name
+        now = event.timestamp
+        if now < self.cooldowns.get(name, 0):
+            return
+
+        window = self.windows.get(name)
+        if window is None:
+            logger.info('Motion window opened on %s', name)
+            window = self.windows[name] = MotionWindow(now)
+        window.last_motion = now
+
+        if window.wants_sample(now):
+            window.samples += 1
+            window.last_sample = now
+            # the tracker just saw the scene change, so detections cached
+            # for how it looked before don't apply
+            detections = utils.report_upstream(
+                event.frame.jpeg(settings=encoders.DETECT))
+            if detections and detections.get('results'):
+                window.reported = True
+
+    def _close_windows(self, now=None):
+        now = now or time.time()
+        for name, window in list(self.windows.items()):
+            if now - window.last_motion > REPORT_UP_DURATION_SECONDS:
+                logger.info('Motion window closed on %s after %i samples',
+                            name, window.samples)
+                del self.windows[name]
+                self.cooldowns[name] = window.last_motion + REPORT_COOLDOWN_SECONDS
+
+
+def start_report_worker():
+    if utils.REPORT_UP and 'SECRET_KEY' in os.environ:
+        ReportWorker().run()
+    else:
+        logger.info(
+            'Not starting report worker, REPORT_UP and SECRET_KEY must be defined')
@@ -0,0 +1,205 @@
+"""Capture storage with retention quotas.
+
+Everything written under the capture directory (motion stills and clips)
+goes through a CaptureStorage. Writes are queued and done in batches by a
+background thread, and after each batch the oldest captures are deleted
+until the directory is within STORAGE_MAX_BYTES and nothing is older than
+STORAGE_MAX_AGE_DAYS. The directory is only scanned once at start up, from
+then on an in-memory index of the files and their sizes is kept up to date
+as captures are written and evicted.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+from camera import metrics
+
+logger = logging.getLogger()
+
+STORAGE_MAX_BYTES = int(float(os.environ.get('STORAGE_MAX_BYTES', 2 * 1024 ** 3)))
+STORAGE_MAX_AGE_DAYS = float(os.environ.get('STORAGE_MAX_AGE_DAYS', 14))
+STORAGE_BATCH_SIZE = int(os.environ.get('STORAGE_BATCH_SIZE', 32))
+# bytes waiting to be written before new data is dropped
+STORAGE_QUEUE_BYTES = int(os.environ.get('STORAGE_QUEUE_BYTES', 16 * 1024 * 1024))
+
+STORAGE_BYTES = metrics.Gauge('storage_bytes', 'Bytes of captures on disk')
+STORAGE_WRITES = metrics.Counter(
+    'storage_writes_total', 'Capture writes by outcome', ['result'])
+
+
+class CaptureStorage(object):
+    """Background writer and retention manager for the capture directory."""
+
+    def __init__(self, root, max_bytes=STORAGE_MAX_BYTES,
+                 max_age=STORAGE_MAX_AGE_DAYS * 24 * 3600,
+                 queue_bytes=STORAGE_QUEUE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue_bytes = queue_bytes
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.index = deque()  # [mtime, size, path], oldest first
+        self.sizes = {}  # path -> index entry
+        self.open_files = {}
+        self.total_bytes = 0
+        self.pending_bytes = 0
+        self.written = 0
+        self.evicted = 0
+        self.dropped = 0
+        self.errors = 0
+        STORAGE_BYTES.set_function(lambda: self.total_bytes)
+        for result in ('written', 'evicted', 'dropped', 'errors'):
+            STORAGE_WRITES.labels(result).set_function(
+                lambda result=result: getattr(self, result))
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self._scan()
+            self.thread = threading.Thread(target=self._run, name='storage')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def save(self, path, data):
+        """Write data as the whole file path."""
+        self._put(('save', path, data))
+
+    def append(self, path, data):
+        """Append data to path, opening it on first use."""
+        self._put(('append', path, data))
+
+    def close(self, path):
+        """Close a file written with append()."""
+        self.queue.put(('close', path, None))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.index),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'oldest': self.index[0][0] if self.index else None,
+                'pending_bytes': self.pending_bytes,
+                'written': self.written,
+                'evicted': self.evicted,
+                'dropped': self.dropped,
+                'errors': self.errors
+            }
+
+    def _put(self, item):
+        with self.lock:
+            if self.pending_bytes + len(item[2]) > self.queue_bytes:
+                self.dropped += 1
+                return
+            self.pending_bytes += len(item[2])
+        self.queue.put(item)
+
+    def _scan(self):
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append([stat.st_mtime, stat.st_size, path])
+        entries.sort()
+        self.index = deque(entries)
+        self.sizes = {entry[2]: entry for entry in entries}
+        self.total_bytes = sum(entry[1] for entry in entries)
+        logger.info('Capture storage holds %i files, %i bytes',
+                    len(self.index), self.total_bytes)
+
+    def _track(self, path, size):
+        """Account for size more bytes written to path."""
+        entry = self.sizes.get(path)
+        if entry is None:
+            entry = self.sizes[path] = [time.time(), 0, path]
+            self.index.append(entry)
+        entry[0] = time.time()
+        entry[1] += size
+        self.total_bytes += size
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < STORAGE_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for op, path, data in batch:
+                try:
+                    self._apply(op, path, data)
+                except (IOError, OSError) as e:
+                    logger.exception(e)
+                    with self.lock:
+                        self.errors += 1
+            for f in self.open_files.values():
+                f.flush()
+            self._evict()
+
+    def _apply(self, op, path, data):
+        if op == 'close':
+            f = self.open_files.pop(path, None)
+            if f is not None:
+                f.close()
+            return
+
+        with self.lock:
+            self.pending_bytes -= len(data)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if op == 'save':
+            with open(path, 'wb') as f:
+                f.write(data)
+            with self.lock:
+                # a rewritten file counts as new, not at its old place in
+                # the index
+                entry = self.sizes.pop(path, None)
+                if entry is not None:
+                    self.index.remove(entry)
+                    self.total_bytes -= entry[1]
+                self._track(path, len(data))
+                self.written += 1
+        elif op == 'append':
+            f = self.open_files.get(path)
+            if f is None:
+                f = self.open_files[path] = open(path, 'ab')
+                with self.lock:
+                    self.written += 1
+            f.write(data)
+            with self.lock:
+                self._track(path, len(data))
+
+    def _evict(self):
+        now = time.time()
+        evicted = []
+        with self.lock:
+            recording = []  # clips still being written, never deleted
+            while self.index:
+                mtime, size, path = self.index[0]
+                if self.total_bytes <= self.max_bytes and now - mtime <= self.max_age:
+                    break
+                entry = self.index.popleft()
+                if path in self.open_files:
+                    recording.append(entry)
+                    continue
+                del self.sizes[path]
+                self.total_bytes -= size
+                self.evicted += 1
+                evicted.append(path)
+            self.index.extendleft(reversed(recording))
+        for path in evicted:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning('Could not evict capture %s: %s', path, e)
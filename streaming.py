@@ -0,0 +1,142 @@
+"""MJPEG stream variants.
+
+Viewers pick a variant of /video_feed with query parameters: ?w=320 scales
+frames down to 320 pixels wide, ?q=60 sets the JPEG quality and ?fps=5 caps
+the frame rate. Each distinct (width, quality) variant is encoded once per
+frame and the part is shared by every viewer asking for it. To bound the
+encoding work at most MJPEG_MAX_VARIANTS variants are live at a time,
+viewers asking for another one get the closest live variant instead.
+"""
+import os
+import time
+import threading
+
+from camera import encoders, metrics
+from camera.base_camera import FULL_RATE
+
+MJPEG_MAX_VARIANTS = int(os.environ.get('MJPEG_MAX_VARIANTS', 4))
+# a variant nobody has streamed for this long no longer counts as live
+MJPEG_VARIANT_IDLE_SECONDS = 10
+MIN_WIDTH = 16
+
+VIEWERS = metrics.Gauge('stream_viewers', 'Clients currently streaming',
+                        ['camera', 'stream'])
+
+
+class StreamOptions(object):
+    __slots__ = ('width', 'quality', 'fps')
+
+    def __init__(self, width=None, quality=None, fps=None):
+        self.width = width
+        self.quality = quality
+        self.fps = fps
+
+    @classmethod
+    def from_args(cls, args):
+        """Read w, q and fps from request arguments, ValueError if they
+        don't parse."""
+        width = _parse(args, 'w', int)
+        quality = _parse(args, 'q', int)
+        fps = _parse(args, 'fps', float)
+        if width is not None and width < MIN_WIDTH:
+            raise ValueError('w must be at least %i' % MIN_WIDTH)
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError('q must be between 1 and 100')
+        # written so NaN fails too
+        if fps is not None and not fps > 0:
+            raise ValueError('fps must be positive')
+        return cls(width, quality, fps)
+
+    @property
+    def variant(self):
+        return self.width, self.quality
+
+
+def _parse(args, name, type):
+    # args.get(name, type=...) would quietly turn a bad value into None
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return type(value)
+    except ValueError:
+        raise ValueError('%s must be %s, got "%s"' % (
+            name, 'an integer' if type is int else 'a number', value))
+
+
+class VariantRegistry(object):
+    """Tracks the live (width, quality) variants of a camera."""
+
+    def __init__(self, max_variants=MJPEG_MAX_VARIANTS,
+                 idle_seconds=MJPEG_VARIANT_IDLE_SECONDS):
+        self.max_variants = max_variants
+        self.idle_seconds = idle_seconds
+        self.last_used = {}
+        self.lock = threading.Lock()
+
+    def select(self, variant):
+        """Return the variant to stream for a request of variant."""
+        now = time.time()
+        with self.lock:
+            for key, last_used in list(self.last_used.items()):
+                if now - last_used > self.idle_seconds:
+                    del self.last_used[key]
+            if variant not in self.last_used and \
+                    len(self.last_used) >= self.max_variants:
+                variant = min(self.last_used, key=lambda live: _distance(live, variant))
+            self.last_used[variant] = now
+            return variant
+
+    def touch(self, variant):
+        with self.lock:
+            self.last_used[variant] = time.time()
+
+
+def _distance(a, b):
+    # None means full width / default quality
+    width_a, quality_a = a
+    width_b, quality_b = b
+    return (abs((width_a or 10000) - (width_b or 10000)) +
+            abs((quality_a or 95) - (quality_b or 95)) * 10)
+
+
+_registries = {}
+_lock = threading.Lock()
+
+
+def get_variants(camera):
+    with _lock:
+        registry = _registries.get(camera.name)
+        if registry is None:
+            registry = _registries[camera.name] = VariantRegistry()
+        return registry
+
+
+def mjpeg_parts(camera, options=None):
+    """Generate multipart parts of camera's frames for one viewer."""
+    options = options or StreamOptions()
+    variants = get_variants(camera)
+    width, quality = variants.select(options.variant)
+    settings = encoders.STREAM.with_quality(quality)
+    interval = 1.0 / options.fps if options.fps else 0
+    fps = options.fps or FULL_RATE
+    viewers = VIEWERS.labels(camera.name, 'mjpeg')
+    viewers.inc()
+    try:
+        seq = None
+        while True:
+            started = time.time()
+            frame = camera.get_frame(after=seq, fps=fps)
+            seq = frame.seq
+            variants.touch((width, quality))
+            # the same bytes object is handed to every viewer of this frame
+            part = frame.mjpeg_part(width=width, settings=settings)
+            # only the part is held while the viewer takes it and waits for
+            # the next frame, a frame would keep its capture buffer in use
+            del frame
+            yield part
+            if interval:
+                time.sleep(max(0, interval - (time.time() - started)))
+    finally:
+        viewers.dec()
+
@@ -4,15 +4,18 @@ import time
 from datetime import datetime
 import logging
 import json
-from importlib import import_module
+import queue
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import cv2
-from apscheduler.schedulers.background import BackgroundScheduler
 
-
-Camera = import_module(
-    'camera.camera_' + os.environ.get('CAMERA', 'opencv')).Camera
+import motion
+import recorder
+import storage
+from camera import encoders, metrics
 
 
 logger = logging.getLogger()
@@ -33,25 +36,131 @@ REMOTE_DETECT_SERVER = os.environ.get(
 UPSTREAM_REPORT_SERVER = os.environ.get(
     'UPSTREAM_REPORT_SERVER', 'https://doorman.printdebug.com/report')
 REPORT_UP = os.environ.get('REPORT_UP') == 'True'
+# how frames are uploaded to REMOTE_DETECT_SERVER: b64 (form field, the
+# original format), multipart (an "image" file part) or binary (raw JPEG body)
+DETECT_UPLOAD_MODE = os.environ.get('DETECT_UPLOAD_MODE', 'b64')
+if DETECT_UPLOAD_MODE not in ('b64', 'multipart', 'binary'):
+    raise ValueError('DETECT_UPLOAD_MODE must be b64, multipart or binary, '
+                     'got "%s"' % DETECT_UPLOAD_MODE)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', 3))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT_SECONDS', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 8))
 RESET_MOTION_TRACKER = int(os.environ.get('RESET_MOTION_TRACKER', 10))
-JOB_ID = 'detect_job'
+MOTION_QUEUE_SIZE = int(os.environ.get('MOTION_QUEUE_SIZE', 64))
+
+DETECT_SECONDS = metrics.Histogram(
+    'detector_request_seconds', 'Round trip time of detector requests')
+DETECT_REQUESTS = metrics.Counter(
+    'detector_requests_total', 'Detector requests by HTTP status', ['status'])
+UPSTREAM_REPORTS = metrics.Counter(
+    'upstream_reports_total', 'Upstream report messages by status and HTTP status',
+    ['status', 'result'])
+MOTION_SECONDS = metrics.Histogram(
+    'motion_detect_seconds', 'Motion detection time per frame', ['camera'])
+MOTION_EVENTS_DROPPED = metrics.Counter(
+    'motion_events_dropped_total',
+    'Motion events dropped because the report worker was behind')
 
 CAPTURE_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 if not os.path.exists(os.path.join(CAPTURE_DIRECTORY, 'capture')):
     os.makedirs(os.path.join(CAPTURE_DIRECTORY, 'capture'))
 CAPTURE_DIRECTORY = os.path.join(CAPTURE_DIRECTORY, 'capture')
+CAPTURE_STORAGE = storage.CaptureStorage(CAPTURE_DIRECTORY)
 
 logger.info('REMOTE_DETECT_SERVER (where yolo detection requests go to) is set to %s',
             REMOTE_DETECT_SERVER)
 
-SCHEDULER = BackgroundScheduler()
+# cleared by kill_job() when upstream rejects our key and reporting has to
+# stop
+REPORTING = threading.Event()
+REPORTING.set()
+
+
+class MotionEvent(object):
+    """Motion seen by a camera's tracker, consumed by the report worker.
+
+    The frame is only encoded if the worker samples it. A queued frame
+    read from a capture process's ring keeps its slot, the ring copies
+    later frames out once too many are kept, which costs no more than
+    copying this one would.
+    """
+    __slots__ = ('camera', 'frame', 'boxes', 'timestamp')
+
+    def __init__(self, camera, frame, boxes):
+        self.camera = camera
+        self.frame = frame
+        self.boxes = boxes  # x, y, w, h rows, largest first
+        self.timestamp = frame.timestamp
+
+
+MOTION_EVENTS = queue.Queue(MOTION_QUEUE_SIZE)
+
+
+def emit_motion(event):
+    """Queue a MotionEvent without ever blocking the tracker, the oldest
+    queued event is dropped when the queue is full."""
+    while True:
+        try:
+            MOTION_EVENTS.put_nowait(event)
+            return
+        except queue.Full:
+            try:
+                MOTION_EVENTS.get_nowait()
+                MOTION_EVENTS_DROPPED.inc()
+            except queue.Empty:
+                pass
+
+
+def _build_session():
+    """A keep-alive session shared by every thread talking to the detector
+    and the upstream reporter.
+
+    Connection failures and gateway errors are retried with a backoff. Read
+    timeouts aren't, the server may already have acted on the request.
+    """
+    retry_options = dict(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0,
+                         status=HTTP_RETRIES, backoff_factor=0.2,
+                         status_forcelist=(502, 503, 504),
+                         raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=None, **retry_options)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=False, **retry_options)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+HTTP_SESSION = _build_session()
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def _detect_payload(jpg):
+    if DETECT_UPLOAD_MODE == 'binary':
+        return {'data': jpg, 'headers': {'Content-Type': 'image/jpeg'}}
+    elif DETECT_UPLOAD_MODE == 'multipart':
+        return {'files': {'image': ('frame.jpg', jpg, 'image/jpeg')}}
+    return {'data': {'b64image': base64.b64encode(jpg)}}
 
 
 def check_detect(jpg):
-    detections = requests.post(REMOTE_DETECT_SERVER,
-                               auth=(DETECT_API_CREDENTIALS['user'],
-                                     DETECT_API_CREDENTIALS['pass']),
-                               data={'b64image': base64.b64encode(jpg)})
+    started = time.time()
+    try:
+        detections = HTTP_SESSION.post(REMOTE_DETECT_SERVER,
+                                       auth=(DETECT_API_CREDENTIALS['user'],
+                                             DETECT_API_CREDENTIALS['pass']),
+                                       timeout=HTTP_TIMEOUT,
+                                       **_detect_payload(jpg))
+    except requests.RequestException:
+        DETECT_REQUESTS.labels('error').inc()
+        raise
+    DETECT_SECONDS.observe(time.time() - started)
+    DETECT_REQUESTS.labels(detections.status_code).inc()
     if detections.status_code == 200:
         return detections.json()
     else:
@@ -60,6 +169,19 @@ def check_detect(jpg):
         detections.raise_for_status()
 
 
+def detect_frame(frame, cache=None, detect=check_detect):
+    """check_detect a Frame, reusing the detections in cache (a
+    detection.DetectionCache) when the scene hasn't changed since."""
+    if cache is not None:
+        detections = cache.get(frame)
+        if detections is not None:
+            return detections
+    detections = detect(frame.jpeg(settings=encoders.DETECT))
+    if cache is not None:
+        cache.put(frame, detections)
+    return detections
+
+
 def draw_boxes(image, boxes):
     image = cv2.rectangle(image,
                           (boxes['topleft']['x'],
@@ -81,148 +203,96 @@ def draw_boxes(image, boxes):
 
 def kill_job():
     _dump_message("======= KILLING JOBS =======")
-    SCHEDULER.remove_all_jobs()
+    REPORTING.clear()
 
 
 def send_upstream_message(message, status):
-    post_up = requests.post(UPSTREAM_REPORT_SERVER, json={
-        'message': message,
-        'status': status,
-        'now': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'key': os.environ['UPSTREAM_SECRET_KEY']
-    })
+    try:
+        post_up = HTTP_SESSION.post(UPSTREAM_REPORT_SERVER, json={
+            'message': message,
+            'status': status,
+            'now': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'key': os.environ['UPSTREAM_SECRET_KEY']
+        }, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        UPSTREAM_REPORTS.labels(status, 'error').inc()
+        raise
+    UPSTREAM_REPORTS.labels(status, post_up.status_code).inc()
     logger.info('Sent message %s', str(message))
     if post_up.status_code != 200:
-        kill_job()
+        # only a rejected key is for good, anything else may pass
+        if post_up.status_code in (401, 403):
+            kill_job()
         post_up.raise_for_status()
 
 
-def report_upstream(frame):
+def report_upstream(jpg):
+    """Detect objects in a JPEG and report them upstream, returns the
+    detections (None if detection failed).
+
+    Failures are logged and reported upstream as errors where possible, the
+    next sample is tried again.
+    """
     try:
-        jpg = cv2.imencode('.jpg', frame)[1]
         detections = check_detect(jpg)
-        if detections['results']:
-            send_upstream_message(
-                message=detections['results'], status='success')
-
     except IOError as e:
-        logger.exception(e)
-        send_upstream_message(message=str(e), status='error')
-        kill_job()
+        logger.error('Detection failed: %s', e)
+        _send_upstream_safely(message=str(e), status='error')
+        return None
+    # check_detect returns None for a success status other than 200
+    if detections and detections.get('results'):
+        _send_upstream_safely(message=detections['results'], status='success')
+    return detections
 
 
-def _start_tracking():
-    # source https://codereview.stackexchange.com/questions/178121/opencv-motion-detection-and-tracking
+def _send_upstream_safely(message, status):
+    # the outcome is counted in UPSTREAM_REPORTS either way
+    try:
+        send_upstream_message(message=message, status=status)
+    except IOError as e:
+        logger.error('Failed to send %s message upstream: %s', status, e)
 
-    # When program is started
-    # Are we finding motion or tracking
-    status = 'motion'
-    # How long have we been tracking
-    idle_time = 0
-    # Background for motion detection
-    background = None
-    # An MIL tracker for when we find motion
-    tracker = cv2.TrackerMIL_create()
 
+def _start_tracking(video):
+    detector = motion.MotionDetector.for_camera(video.name)
     last_recorded = datetime.now()
 
-    # Webcam footage (or video)
-    video = Camera()
+    # captures are kept apart per camera
+    capture_directory = os.path.join(CAPTURE_DIRECTORY, video.name)
+    CAPTURE_STORAGE.start()
+    clips = recorder.ClipRecorder(video, capture_directory, CAPTURE_STORAGE)
+    clips.start()
 
-    # LOOP
+    motion_seconds = MOTION_SECONDS.labels(video.name)
+    seq = None
     while True:
-        # Check first frame
-        frame, _ = video.get_frame()
-
-        # Grayscale footage
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        # Blur footage to prevent artifacts
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-        # Check for background
-        if background is None:
-            # Set background to current frame
-            background = gray
-
-        if status == 'motion':
-            # Difference between current frame and background
-            frame_delta = cv2.absdiff(background, gray)
-            # Create a threshold to exclude minute movements
-            thresh = cv2.threshold(frame_delta, 25, 255, cv2.THRESH_BINARY)[1]
-
-            # Dialate threshold to further reduce error
-            thresh = cv2.dilate(thresh, None, iterations=2)
-            # Check for contours in our threshold
-            _, cnts, hierarchy = cv2.findContours(
-                thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # Check each contour
-            if len(cnts) != 0:
-                # If the contour is big enough
-
-                # Set largest contour to first contour
-                largest = 0
-
-                # For each contour
-                for i in range(len(cnts)):
-                    # If this contour is larger than the largest
-                    if i != 0 & int(cv2.contourArea(cnts[i])) > int(cv2.contourArea(cnts[largest])):
-                        # This contour is the largest
-                        largest = i
-
-                if cv2.contourArea(cnts[largest]) > 1100:
-                    # Create a bounding box for our contour
-                    (x, y, w, h) = cv2.boundingRect(cnts[0])
-                    # Convert from float to int, and scale up our boudning box
-                    (x, y, w, h) = (int(x), int(y), int(w), int(h))
-                    # Initialize tracker
-                    bbox = (x, y, w, h)
-                    try:
-                        ok = tracker.init(frame, bbox)
-                        # Switch from finding motion to tracking
-                        status = 'tracking'
-                    except cv2.error as e:
-                        logger.exception(e)
-
-        # If we are tracking
-        if status == 'tracking':
-            # Update our tracker
-            ok, bbox = tracker.update(frame)
-            # Create a visible rectangle for our viewing pleasure
-            if ok:
-                now = datetime.now()
-                p1 = (int(bbox[0]), int(bbox[1]))
-                p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
-                # cv2.rectangle(frame, p1, p2, (0, 0, 255), 1)
-                if (now - last_recorded).total_seconds() > RESET_MOTION_TRACKER:
-                    logger.info('Motion detected at %s', str(now))
-                    cv2.imwrite(os.path.join(
-                        CAPTURE_DIRECTORY, now.strftime('%Y-%m-%d_%H_%M_%S') + '.jpg'), frame)
-                    last_recorded = now
-
-        # If we have been tracking for more than a few seconds
-        if idle_time >= 2:
-            # Reset to motion
-            status = 'motion'
-            # Reset timer
-            idle_time = 0
-
-            # Reset background, frame, and tracker
-            background = None
-            tracker = None
-            ok = None
-
-            # Recreate tracker
-            tracker = cv2.TrackerMIL_create()
-
-        # Incriment timer
-        idle_time += 1
-
-
-def start_motion_tracker():
+        # only look at MOTION_FPS frames a second, the newest one each time
+        started = time.time()
+        frame = video.get_frame(after=seq, fps=detector.fps)
+        seq = frame.seq
+
+        with motion_seconds.time():
+            boxes = detector.detect(frame)
+        if len(boxes):
+            emit_motion(MotionEvent(video, frame, boxes))
+            clips.trigger(frame.timestamp)
+            now = datetime.now()
+            if (now - last_recorded).total_seconds() > RESET_MOTION_TRACKER:
+                logger.info('Motion detected on %s at %s', video.name, str(now))
+                CAPTURE_STORAGE.save(os.path.join(
+                    capture_directory, now.strftime('%Y-%m-%d_%H_%M_%S') + '.jpg'),
+                    frame.jpeg(settings=encoders.CAPTURE))
+                last_recorded = now
+        # not held while waiting for the next one
+        del frame
+
+        time.sleep(max(0, detector.interval - (time.time() - started)))
+
+
+def start_motion_tracker(camera):
     if REPORT_UP and 'SECRET_KEY' in os.environ:
-        logger.info('Starting motiong tracker')
-        _start_tracking()
+        logger.info('Starting motiong tracker for %s', camera.name)
+        _start_tracking(camera)
     else:
         logger.info(
             'Not starting motiong tracker, REPORT_UP and SECRET_KEY must be defined')